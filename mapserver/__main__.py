@@ -27,6 +27,7 @@ import sys
 
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
+import hypercorn.run
 import yaml
 
 #===============================================================================
@@ -99,37 +100,48 @@ loggers:
 
 #===============================================================================
 
-def configure_logging(access_log: str, error_log: str, litestar_log: str):
-    config = LOGGING_CONFIG.format(ACCESS_LOG=access_log, ERROR_LOG=error_log, LITESTAR_LOG=litestar_log)
+def configure_logging():
+    ACCESS_LOG_FILE = os.path.join(settings['FLATMAP_SERVER_LOGS'], 'access_log')
+    ERROR_LOG_FILE = os.path.join(settings['FLATMAP_SERVER_LOGS'], 'error_log')
+    LITESTAR_LOG_FILE = os.path.join(settings['FLATMAP_SERVER_LOGS'], 'maker_log')
+    config = LOGGING_CONFIG.format(ACCESS_LOG=ACCESS_LOG_FILE, ERROR_LOG=ERROR_LOG_FILE, LITESTAR_LOG=LITESTAR_LOG_FILE)
     logging.config.dictConfig(yaml.safe_load(config))
 
 #===============================================================================
 
-async def run_server(viewer=False):
-#==================================
-    # Save viewer state for server initialisation
+def run_server(viewer=False):
+#===========================
+    # Save viewer state for server initialisation, and for any worker processes
     settings['MAP_VIEWER'] = viewer
+    if viewer:
+        os.environ['MAP_VIEWER'] = 'true'
 
-    ACCESS_LOG_FILE = os.path.join(settings['FLATMAP_SERVER_LOGS'], 'access_log')
-    ERROR_LOG_FILE = os.path.join(settings['FLATMAP_SERVER_LOGS'], 'error_log')
-    LITESTAR_LOG_FILE = os.path.join(settings['FLATMAP_SERVER_LOGS'], 'maker_log')
-    configure_logging(ACCESS_LOG_FILE, ERROR_LOG_FILE, LITESTAR_LOG_FILE)
+    configure_logging()
 
     config = Config()
     config.accesslog = logging.getLogger('hypercorn.access')
     config.errorlog = logging.getLogger('hypercorn.error')
 
     config.bind = [f'{SERVER_INTERFACE}:{SERVER_PORT}']
-    asyncio.run(
-        serve(app, config)
-    )
+    if settings['SERVER_WORKERS'] > 1:
+        # Worker processes share our listening socket and load the server
+        # application themselves
+        config.workers = settings['SERVER_WORKERS']
+        config.application_path = 'mapserver.worker:app'
+        # Daemon processes can't start the processes that make maps
+        config.daemon = False
+        hypercorn.run.run(config)
+    else:
+        asyncio.run(
+            serve(app, config)
+        )
 
 #===============================================================================
 
 def main(viewer=False):
 #======================
     try:
-        asyncio.run(run_server(viewer))
+        run_server(viewer)
     except KeyboardInterrupt:
         pass
 
@@ -18,24 +18,28 @@
 #
 #===============================================================================
 
+from collections import defaultdict
+import fcntl
 import functools
 import importlib.resources
-import itertools
 import json
 import os
-from typing import cast, Optional
+from typing import Optional
 
 #===============================================================================
 
 import networkx as nx
 import rdflib
+from rdflib.namespace import OWL, RDF, RDFS
 
 #===============================================================================
 
 from ..settings import settings
-from ..utils import json_map_metadata
+from ..utils import json_map_metadata, save_json
 
+from .hierarchy_index import HierarchyIndex, root_distances, source_signature
 from .rdf_utils import ILX_BASE, Node, Triple, Uri
+from .turtle import TurtleScanner
 
 #===============================================================================
 
@@ -47,6 +51,7 @@ TREE_VERSION = '1.1'
 
 CACHED_MAP_HIERARCHY = 'hierarchy.json'
 CACHED_SPARC_HIERARCHY = 'sparc-hierarchy.json'
+CACHED_SPARC_INDEX = 'sparc-hierarchy.index'
 
 #===============================================================================
 
@@ -64,7 +69,7 @@ BODY_PROPER = Uri('UBERON:0013702')
 
 #===============================================================================
 
-ILX_PART_OF = 'ILX:0112785'
+ILX_PART_OF = rdflib.URIRef(f'{ILX_BASE}0112785')
 
 IS_A = 'is_a'
 PART_OF = Uri('BFO:0000050')
@@ -136,9 +141,9 @@ class Arborescence:
 #===============================================================================
 
 class IlxTerm:
-    def __init__(self, result_row: rdflib.query.ResultRow):
-        self.__uri = Uri(result_row.term)
-        self.__label = result_row.get('label')
+    def __init__(self, uri: rdflib.URIRef, label: Optional[rdflib.Literal]):
+        self.__uri = Uri(uri)
+        self.__label = label
         self.__parents: list[Uri] = []
         self.__have_ilx_parents = False
 
@@ -165,47 +170,59 @@ class IlxTerm:
 
 #===============================================================================
 
-ILX_TERM_QUERY = f"""
-    prefix ILX: <{ILX_BASE}>
-    prefix owl: <http://www.w3.org/2002/07/owl#>
-    prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-    select ?term ?label ?p1 ?p2 where
-    {{
-        ?term a owl:Class ;
-              rdfs:label ?label ;
-              rdfs:subClassOf ?p1 .
-        optional {{
-            ?p1 a owl:Restriction ;
-                owl:onProperty {ILX_PART_OF} ;
-                owl:someValuesFrom ?p2 . }}
-    }}
-    order by ?term"""
-
-class IlxTerms(rdflib.Graph):
-#============================
+class IlxTerms:
+#==============
+    """
+    Interlex classes that have a label and are sub-classes of, or part of,
+    other terms, found in a single scan of a Turtle source.
+    """
     def __init__(self, ttl_source):
-        super().__init__()
-        with open(ttl_source) as fp:
-            self.parse(fp)
+        self.__classes: set[rdflib.URIRef] = set()
+        self.__labels: dict[rdflib.URIRef, rdflib.Literal] = {}
+        self.__super_classes: defaultdict[rdflib.URIRef, list[rdflib.URIRef|rdflib.BNode|rdflib.Literal]] = defaultdict(list)
+        self.__restrictions: set[rdflib.BNode] = set()
+        self.__part_of: set[rdflib.BNode] = set()
+        self.__restriction_values: defaultdict[rdflib.BNode, list[rdflib.URIRef]] = defaultdict(list)
+        # Only interlex classes can be terms and only blank nodes can be the
+        # restrictions that give their parents
+        for (s, p, o) in TurtleScanner(ttl_source).triples():
+            if p == RDF.type:
+                if o == OWL.Class and isinstance(s, rdflib.URIRef) and s.startswith(ILX_BASE):
+                    self.__classes.add(s)
+                elif o == OWL.Restriction and isinstance(s, rdflib.BNode):
+                    self.__restrictions.add(s)
+            elif p == RDFS.label:
+                if isinstance(s, rdflib.URIRef) and s.startswith(ILX_BASE) and isinstance(o, rdflib.Literal):
+                    self.__labels.setdefault(s, o)
+            elif p == RDFS.subClassOf:
+                if isinstance(s, rdflib.URIRef) and s.startswith(ILX_BASE):
+                    self.__super_classes[s].append(o)
+            elif p == OWL.onProperty:
+                if o == ILX_PART_OF and isinstance(s, rdflib.BNode):
+                    self.__part_of.add(s)
+            elif p == OWL.someValuesFrom:
+                if isinstance(s, rdflib.BNode) and isinstance(o, rdflib.URIRef):
+                    self.__restriction_values[s].append(o)
 
     def term_list(self):
-        last_uri = None
-        ilx_term = None
-        for row in self.query(ILX_TERM_QUERY):
-            result_row = cast(rdflib.query.ResultRow, row)
-            if result_row.term.startswith(ILX_BASE):
-                if ilx_term is None or last_uri != Uri(result_row.term):
-                    if ilx_term is not None:
+        # A term is yielded as each of its parents is found, and again once
+        # it is complete, so that the hierarchy built from the terms is the
+        # same as when they came from rows of a SPARQL query
+        for uri in sorted(self.__classes):
+            if uri in self.__labels and uri in self.__super_classes:
+                ilx_term = IlxTerm(uri, self.__labels[uri])
+                for parent in self.__super_classes[uri]:
+                    if isinstance(parent, rdflib.URIRef):
+                        ilx_term.add_parent(parent)
+                        yield ilx_term
+                    elif (isinstance(parent, rdflib.BNode)
+                      and parent in self.__restrictions and parent in self.__part_of
+                      and len(self.__restriction_values[parent])):
+                        for value in self.__restriction_values[parent]:
+                            ilx_term.add_parent(value)
+                            yield ilx_term
+                    else:
                         yield ilx_term
-                    ilx_term = IlxTerm(result_row)
-                    last_uri = ilx_term.uri
-                if isinstance(result_row.p1, rdflib.URIRef):
-                    ilx_term.add_parent(result_row.p1)
-                elif (isinstance(result_row.p1, rdflib.BNode)
-                  and isinstance(result_row.p2, rdflib.URIRef)):
-                    ilx_term.add_parent(result_row.p2)
-            if ilx_term is not None:
                 yield ilx_term
 
 #===============================================================================
@@ -230,21 +247,37 @@ class UberonGraph(nx.DiGraph):
 class SparcHierarchy:
     def __init__(self, uberon_source: str, interlex_source: str):
         hierarchy_file = os.path.join(settings['FLATMAP_ROOT'], CACHED_SPARC_HIERARCHY)
+        index_file = os.path.join(settings['FLATMAP_ROOT'], CACHED_SPARC_INDEX)
+
+        # The hierarchy is served from a memory-mapped index that holds both
+        # its graph and the distances between terms. The index is rebuilt
+        # whenever the cached JSON hierarchy is
         try:
-            with open(hierarchy_file) as fp:
-                graph_json = json.load(fp)
-                self.__graph = nx.node_link_graph(graph_json, edges='links', directed=True)  # type: ignore
-                return
-        except Exception:
-            pass
-        self.__graph = UberonGraph(uberon_source)
-        self.__add_ilx_terms(interlex_source)
-        graph_json = nx.node_link_data(self.__graph, edges='links')     # type: ignore
-        with open(hierarchy_file, 'w') as fp:
-            json.dump(graph_json, fp)
+            index = HierarchyIndex.load(index_file, source_signature(hierarchy_file))
+        except OSError:
+            index = None
+        if index is None:
+            try:
+                with open(hierarchy_file) as fp:
+                    graph_json = json.load(fp)
+                    self.__graph = nx.node_link_graph(graph_json, edges='links', directed=True)  # type: ignore
+            except Exception:
+                self.__graph = UberonGraph(uberon_source)
+                self.__add_ilx_terms(interlex_source)
+                graph_json = nx.node_link_data(self.__graph, edges='links')     # type: ignore
+                save_json(hierarchy_file, graph_json)
+            index = HierarchyIndex.build(self.__graph, ANATOMICAL_ROOT.id)
+            try:
+                index.save(index_file, source_signature(hierarchy_file))
+            except OSError:
+                pass
+            del self.__graph
+        self.__index = index
 
     def __add_ilx_terms(self, interlex_source: str):
     #===============================================
+        # Distances to the root are kept up to date as Interlex terms are added
+        self.__depths = root_distances(self.__graph, ANATOMICAL_ROOT.id)
         ilx_terms = IlxTerms(interlex_source)
         have_ilx_parents = []
         for ilx_term in ilx_terms.term_list():
@@ -274,32 +307,68 @@ class SparcHierarchy:
         max_parent_distance = 0
         for parent in ilx.parents:
             if parent.id in self.__graph:
-                distance = self.distance_to_root(parent)
+                distance = self.__depths.get(parent.id, -1)
                 if distance > max_parent_distance:
                     furthest_term = parent
                     max_parent_distance = distance
         if furthest_term is not None:
             self.__graph.add_edge(ilx.uri.id, furthest_term.id)
+            self.__update_depths(ilx.uri.id, max_parent_distance + 1)
+
+    def __update_depths(self, term_id: str, depth: int):
+    #===================================================
+        # A term may be added again with another parent, giving it and
+        # its descendants a shorter path to the root
+        queue = [(term_id, depth)]
+        while len(queue):
+            (term_id, depth) = queue.pop()
+            if depth < self.__depths.get(term_id, depth + 1):
+                self.__depths[term_id] = depth
+                queue.extend((child, depth + 1) for child in self.__graph.predecessors(term_id))
+
+    def ancestor_distances(self, source: Uri) -> dict[str, int]:
+    #==========================================================
+        """
+        The length of the shortest path from a term to each of its ancestors,
+        keyed by ancestor id, and including the term itself at distance 0.
+        """
+        return self.__index.ancestor_distances(source.id)
 
     def distance_to_root(self, source):
     #==================================
-        return self.path_length(source, ANATOMICAL_ROOT)
+        return self.__index.depth(source.id)
 
     def has(self, term: Uri) -> bool:
     #=================================
-        return term is not None and str(term) in self.__graph
+        return term is not None and self.__index.has(str(term))
 
     def label(self, term: Uri) -> str:
     #=================================
-        return self.__graph.nodes[term.id]['label']
+        return self.__index.label(term.id)
 
     def path_length(self, source, target):
     #=====================================
-        try:
-            return nx.shortest_path_length(self.__graph, source.id, target.id)
-        except (nx.NetworkXNoPath, nx.NodeNotFound):
-            pass
-        return -1
+        return self.__index.path_length(source.id, target.id)
+
+#===============================================================================
+
+def build_sparc_hierarchy():
+#===========================
+    """
+    Build and cache the SPARC hierarchy and its index, if not already cached.
+
+    This is slow and is run in a separate process. A lock means that server
+    processes don't build the hierarchy at the same time, with any waiting
+    for the lock then finding it cached.
+    """
+    lock_file = os.path.join(settings['FLATMAP_ROOT'], f'{CACHED_SPARC_HIERARCHY}.lock')
+    with open(lock_file, 'w') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        SparcHierarchy(UBERON_ONTOLOGY, NPO_ONTOLOGY)
+
+def sparc_hierarchy_cached() -> bool:
+#====================================
+    return os.path.exists(os.path.join(settings['FLATMAP_ROOT'], CACHED_SPARC_HIERARCHY))
 
 #===============================================================================
 
@@ -338,12 +407,14 @@ class AnatomicalHierarchy:
 
         # Find the shortest path between each pair of SPARC terms used in the flatmap,
         # including to the ANATOMICAL_ROOT node, and if a path exists, add an edge to
-        # the graph
+        # the graph. A single search from each term finds the paths to all of its
+        # ancestors, rather than searching for a path between every pair of terms
         map_terms.add(ANATOMICAL_ROOT)
-        for source, target in itertools.permutations(map_terms, 2):
-            path_length = self.__sparc_hierarchy.path_length(source, target)
-            if path_length > 0:
-                hierarchy_graph.add_edge(source.id, target.id, parent_distance=path_length)
+        for source in map_terms:
+            ancestor_distances = self.__sparc_hierarchy.ancestor_distances(source)
+            for target in map_terms:
+                if ancestor_distances.get(target.id, -1) > 0:
+                    hierarchy_graph.add_edge(source.id, target.id, parent_distance=ancestor_distances[target.id])
 
         # For each term used by the flatmap find the closest term(s) it is connected to and
         # delete edges connecting to more distant terms
@@ -365,8 +436,7 @@ class AnatomicalHierarchy:
         hierarchy_tree = Arborescence(hierarchy_graph, ANATOMICAL_ROOT, BODY_PROPER).tree
         hierarchy_tree.graph['version'] = TREE_VERSION  # type: ignore
         hierarchy = nx.node_link_data(hierarchy_tree, edges='links')    # type: ignore
-        with open(hierarchy_file, 'w') as fp:
-            json.dump(hierarchy, fp)
+        save_json(hierarchy_file, hierarchy)
         return hierarchy
 
 #===============================================================================
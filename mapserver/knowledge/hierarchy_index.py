@@ -0,0 +1,277 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from array import array
+import bisect
+from collections import deque
+import mmap
+import os
+import pathlib
+import struct
+import sys
+from typing import Literal, Mapping, Optional
+
+#===============================================================================
+
+import networkx as nx
+
+#===============================================================================
+
+INDEX_MAGIC = b'SHIX'
+INDEX_VERSION = 2
+
+# Magic, version, the number of nodes, parent edges and ancestors, the sizes
+# of the node id and label strings, and the size and modification time of the
+# hierarchy the index is for
+INDEX_HEADER = struct.Struct('<4sH2xIIIQQQQ')
+
+# Arrays follow the header, in this order, with their type and length given by
+# the number of nodes (``n``), parent edges (``e``) and ancestors (``a``), and
+# then node ids and labels, as UTF-8 strings
+INDEX_ARRAYS: list[tuple[str, Literal['i', 'I', 'H'], str]] = [
+    ('depths',           'i', 'n'),
+    ('id_offsets',       'I', 'n+1'),
+    ('label_offsets',    'I', 'n+1'),
+    ('parent_offsets',   'I', 'n+1'),
+    ('parents',          'I', 'e'),
+    ('ancestor_offsets', 'I', 'n+1'),
+    ('ancestors',        'I', 'a'),
+    ('distances',        'H', 'a'),
+]
+
+#===============================================================================
+
+"""
+Identifies the version of a cached hierarchy that an index was built for.
+"""
+SourceSignature = tuple[int, int]
+
+def source_signature(path: str) -> SourceSignature:
+#==================================================
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+#===============================================================================
+
+def root_distances(graph: nx.DiGraph, root: str) -> dict[str, int]:
+#==================================================================
+    """
+    The length of the shortest path from each node to the root, for those
+    nodes connected to it.
+    """
+    if root not in graph:
+        return {}
+    distances = {root: 0}
+    queue = deque([root])
+    while len(queue):
+        node = queue.popleft()
+        for child in graph.predecessors(node):
+            if child not in distances:
+                distances[child] = distances[node] + 1
+                queue.append(child)
+    return distances
+
+#===============================================================================
+
+def string_table(strings: list[str]) -> tuple[bytes, array]:
+#===========================================================
+    encoded = [string.encode() for string in strings]
+    offsets = array('I', [0])
+    for string in encoded:
+        offsets.append(offsets[-1] + len(string))
+    return (b''.join(encoded), offsets)
+
+#===============================================================================
+
+class HierarchyIndex:
+    """
+    A compact, read-only form of a hierarchy's graph, along with each node's
+    distance to the root of the hierarchy, and to each of its ancestors, so
+    that these are found without searching the graph.
+
+    Nodes are numbered by their position in the graph. A node's parents, and
+    its ancestors, are held in compressed sparse rows: for instance,
+    ``parents[parent_offsets[n]:parent_offsets[n+1]]`` are node ``n``'s
+    parents. Node ids and labels are held as offsets into UTF-8 strings.
+
+    A saved index is memory-mapped when loaded, so loading is fast and
+    server processes share the pages of the file.
+    """
+    def __init__(self, arrays: Mapping[str, array|memoryview], ids: bytes|memoryview, labels: bytes|memoryview,
+                 buffer: Optional[mmap.mmap]=None):
+        self.__arrays = arrays
+        self.__labels = labels
+        self.__buffer = buffer
+        id_offsets = arrays['id_offsets']
+        self.__node_ids = [bytes(ids[id_offsets[n]:id_offsets[n+1]]).decode() for n in range(len(id_offsets) - 1)]
+        self.__node_index = {node_id: n for (n, node_id) in enumerate(self.__node_ids)}
+        self.__depths = arrays['depths']
+        self.__parent_offsets = arrays['parent_offsets']
+        self.__parents = arrays['parents']
+        self.__ancestor_offsets = arrays['ancestor_offsets']
+        self.__ancestors = arrays['ancestors']
+        self.__distances = arrays['distances']
+
+    @classmethod
+    def build(cls, graph: nx.DiGraph, root: str) -> 'HierarchyIndex':
+    #=================================================================
+        node_ids = list(graph.nodes)
+        node_index = {node_id: n for (n, node_id) in enumerate(node_ids)}
+        depths_to_root = root_distances(graph, root)
+        arrays = {
+            'depths': array('i', [depths_to_root.get(node_id, -1) for node_id in node_ids]),
+            'parent_offsets': array('I', [0]),
+            'parents': array('I'),
+            'ancestor_offsets': array('I', [0]),
+            'ancestors': array('I'),
+            'distances': array('H'),
+        }
+        for node_id in node_ids:
+            arrays['parents'].extend(sorted(node_index[parent] for parent in graph.successors(node_id)))
+            arrays['parent_offsets'].append(len(arrays['parents']))
+            node_ancestors = sorted((node_index[ancestor], distance)
+                                        for (ancestor, distance) in nx.single_source_shortest_path_length(graph, node_id).items()
+                                            if ancestor != node_id)
+            arrays['ancestors'].extend(ancestor for (ancestor, _) in node_ancestors)
+            arrays['distances'].extend(distance for (_, distance) in node_ancestors)
+            arrays['ancestor_offsets'].append(len(arrays['ancestors']))
+        (ids, arrays['id_offsets']) = string_table(node_ids)
+        (labels, arrays['label_offsets']) = string_table([str(graph.nodes[node_id].get('label', node_id))
+                                                            for node_id in node_ids])
+        return cls(arrays, ids, labels)
+
+    @classmethod
+    def load(cls, path: str, signature: SourceSignature) -> Optional['HierarchyIndex']:
+    #==================================================================================
+        """
+        Load an index, provided it is for the given version of its hierarchy.
+        """
+        try:
+            with open(path, 'rb') as fp:
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            header = INDEX_HEADER.unpack_from(buffer)
+            if (header[0] != INDEX_MAGIC or header[1] != INDEX_VERSION
+             or (header[7], header[8]) != signature):
+                return None
+            (node_count, edge_count, ancestor_count, ids_size, labels_size) = header[2:7]
+            lengths = {'n': node_count, 'n+1': node_count + 1, 'e': edge_count, 'a': ancestor_count}
+            view = memoryview(buffer)
+            offset = INDEX_HEADER.size
+            arrays: dict[str, memoryview] = {}
+            for (name, typecode, length) in INDEX_ARRAYS:
+                size = lengths[length]*array(typecode).itemsize
+                values = view[offset:offset+size].cast(typecode)
+                if sys.byteorder != 'little':
+                    swapped = array(typecode, values)
+                    swapped.byteswap()
+                    values = memoryview(swapped)
+                arrays[name] = values
+                offset += size
+            ids = view[offset:offset+ids_size]
+            labels = view[offset+ids_size:offset+ids_size+labels_size]
+            if offset + ids_size + labels_size != len(buffer):
+                return None
+        except (struct.error, TypeError, ValueError):
+            return None
+        return cls(arrays, ids, labels, buffer)
+
+    def save(self, path: str, signature: SourceSignature):
+    #=====================================================
+        (ids, _) = string_table(self.__node_ids)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as fp:
+                fp.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(self.__node_ids),
+                                           len(self.__parents), len(self.__ancestors),
+                                           len(ids), len(self.__labels), *signature))
+                for (name, typecode, _) in INDEX_ARRAYS:
+                    values = array(typecode, self.__arrays[name])
+                    if sys.byteorder != 'little':
+                        values.byteswap()
+                    values.tofile(fp)
+                fp.write(ids)
+                fp.write(self.__labels)
+            os.replace(temp_path, path)
+        except BaseException:
+            pathlib.Path(temp_path).unlink(missing_ok=True)
+            raise
+
+    def has(self, node_id: str) -> bool:
+    #===================================
+        return node_id in self.__node_index
+
+    def label(self, node_id: str) -> str:
+    #====================================
+        n = self.__node_index[node_id]
+        label_offsets = self.__arrays['label_offsets']
+        return bytes(self.__labels[label_offsets[n]:label_offsets[n+1]]).decode()
+
+    def parents(self, node_id: str) -> list[str]:
+    #============================================
+        if (n := self.__node_index.get(node_id)) is None:
+            return []
+        return [self.__node_ids[parent]
+                    for parent in self.__parents[self.__parent_offsets[n]:self.__parent_offsets[n+1]]]
+
+    def depth(self, node_id: str) -> int:
+    #====================================
+        """
+        A node's distance to the root, or ``-1`` if it isn't connected to it.
+        """
+        if (n := self.__node_index.get(node_id)) is None:
+            return -1
+        return self.__depths[n]
+
+    def path_length(self, source_id: str, target_id: str) -> int:
+    #============================================================
+        """
+        The length of the shortest path from a node to one of its ancestors,
+        or ``-1`` if there is no path.
+        """
+        if (source := self.__node_index.get(source_id)) is None:
+            return -1
+        if source_id == target_id:
+            return 0
+        if (target := self.__node_index.get(target_id)) is None:
+            return -1
+        (start, end) = (self.__ancestor_offsets[source], self.__ancestor_offsets[source + 1])
+        position = bisect.bisect_left(self.__ancestors, target, start, end)
+        if position < end and self.__ancestors[position] == target:
+            return self.__distances[position]
+        return -1
+
+    def ancestor_distances(self, node_id: str) -> dict[str, int]:
+    #============================================================
+        """
+        The distance from a node to each of its ancestors, keyed by ancestor
+        id, and including the node itself at distance 0.
+        """
+        if (n := self.__node_index.get(node_id)) is None:
+            return {}
+        (start, end) = (self.__ancestor_offsets[n], self.__ancestor_offsets[n + 1])
+        distances = {node_id: 0}
+        distances.update((self.__node_ids[ancestor], distance)
+                            for (ancestor, distance) in zip(self.__ancestors[start:end], self.__distances[start:end]))
+        return distances
+
+#===============================================================================
@@ -0,0 +1,252 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import re
+from typing import Iterator, Optional
+from urllib.parse import urljoin
+
+#===============================================================================
+
+from rdflib import BNode, Literal, URIRef
+from rdflib.namespace import RDF, XSD
+
+#===============================================================================
+
+"""
+A subject, predicate and object, as ``rdflib`` terms.
+"""
+TurtleTriple = tuple[URIRef|BNode, URIRef, URIRef|BNode|Literal]
+
+"""
+The kind of a token, as named in ``TOKENS``, and its text.
+"""
+Token = tuple[str, str]
+
+#===============================================================================
+
+TOKENS = re.compile(r'''
+    (?P<space>(?:\s+|\#[^\n]*)+)
+  | (?P<iri><[^>]*>)
+  | (?P<string>"""(?:[^"\\]|\\.|"(?!""))*"""
+              |\'\'\'(?:[^'\\]|\\.|'(?!''))*\'\'\'
+              |"(?:[^"\\\n]|\\.)*"
+              |'(?:[^'\\\n]|\\.)*')
+  | (?P<at>@[A-Za-z]+(?:-[A-Za-z0-9]+)*)
+  | (?P<datatype>\^\^)
+  | (?P<punctuation>[;,.\[\]()])
+  | (?P<name>[^\s<>"'\[\]();,]*[^\s<>"'\[\]();,.])
+    ''', re.VERBOSE | re.DOTALL)
+
+ESCAPES = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))', re.DOTALL)
+CHARACTER_ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f'}
+
+NUMBER = re.compile(r'[+-]?(?:\d+|\d*\.\d+(?:[eE][+-]?\d+)?|\d+(?:\.\d*)?[eE][+-]?\d+)$')
+
+#===============================================================================
+
+def unescape(text: str) -> str:
+#==============================
+    def replace(match: re.Match[str]) -> str:
+        if (character := match.group(3)) is None:
+            return chr(int(match.group(1) or match.group(2), 16))
+        return CHARACTER_ESCAPES.get(character, character)
+    return ESCAPES.sub(replace, text) if '\\' in text else text
+
+#===============================================================================
+
+class TurtleScanner:
+    """
+    Scan a Turtle document for its triples, in document order, without
+    building a graph of them.
+
+    Covers the Turtle used by ontologies such as ``npo.ttl``: prefixes and
+    base IRIs, prefixed names, literals with language tags or datatypes,
+    and blank nodes, including property lists and collections.
+    """
+    def __init__(self, source: str):
+        with open(source, encoding='utf-8') as fp:
+            self.__text = fp.read()
+        self.__source = source
+        self.__tokens = self.__scan_tokens()
+        self.__lookahead: Optional[Token] = next(self.__tokens, None)
+        self.__base = ''
+        self.__prefixes: dict[str, str] = {}
+        self.__triples: list[TurtleTriple] = []
+
+    def __scan_tokens(self) -> Iterator[Token]:
+    #==========================================
+        position = 0
+        while position < len(self.__text):
+            match = TOKENS.match(self.__text, position)
+            if match is None or match.lastgroup is None:
+                raise ValueError(f'{self.__source}: unexpected text at offset {position}')
+            if match.lastgroup != 'space':
+                yield (match.lastgroup, match.group())
+            position = match.end()
+
+    def __next(self) -> Token:
+    #=========================
+        if self.__lookahead is None:
+            raise ValueError(f'{self.__source}: unexpected end of document')
+        token = self.__lookahead
+        self.__lookahead = next(self.__tokens, None)
+        return token
+
+    def __peek(self) -> Optional[str]:
+    #=================================
+        return self.__lookahead[1] if self.__lookahead is not None else None
+
+    def __expect(self, value: str):
+    #==============================
+        (_, token) = self.__next()
+        if token != value:
+            raise ValueError(f"{self.__source}: expected '{value}' but found '{token}'")
+
+    def triples(self) -> Iterator[TurtleTriple]:
+    #===========================================
+        while self.__lookahead is not None:
+            (kind, token) = self.__lookahead
+            if kind == 'at' or token.upper() in ['PREFIX', 'BASE']:
+                self.__directive()
+            else:
+                self.__statement()
+            yield from self.__triples
+            self.__triples = []
+
+    def __directive(self):
+    #=====================
+        (_, keyword) = self.__next()
+        if keyword.lower() in ['@prefix', 'prefix']:
+            (_, prefix) = self.__next()
+            self.__prefixes[prefix[:-1]] = self.__iri(self.__next()[1])
+        elif keyword.lower() in ['@base', 'base']:
+            self.__base = self.__iri(self.__next()[1])
+        else:
+            raise ValueError(f"{self.__source}: unknown directive '{keyword}'")
+        if keyword.startswith('@'):
+            self.__expect('.')
+
+    def __statement(self):
+    #=====================
+        if self.__peek() == '[':
+            subject = self.__blank_node()
+            if self.__peek() != '.':
+                self.__predicate_objects(subject)
+        else:
+            subject = self.__term()
+            if isinstance(subject, Literal):
+                raise ValueError(f"{self.__source}: literal '{subject}' cannot be a subject")
+            self.__predicate_objects(subject)
+        self.__expect('.')
+
+    def __predicate_objects(self, subject: URIRef|BNode):
+    #===================================================
+        while True:
+            predicate = self.__predicate()
+            while True:
+                self.__triples.append((subject, predicate, self.__term()))
+                if self.__peek() != ',':
+                    break
+                self.__next()
+            while self.__peek() == ';':
+                self.__next()
+            if self.__peek() in ['.', ']', None]:
+                break
+
+    def __predicate(self) -> URIRef:
+    #===============================
+        (_, token) = self.__next()
+        if token == 'a':
+            return RDF.type
+        elif isinstance(predicate := self.__resource(token), URIRef):
+            return predicate
+        raise ValueError(f"{self.__source}: blank node '{token}' cannot be a predicate")
+
+    def __blank_node(self) -> BNode:
+    #===============================
+        self.__expect('[')
+        node = BNode()
+        if self.__peek() != ']':
+            self.__predicate_objects(node)
+        self.__expect(']')
+        return node
+
+    def __collection(self) -> URIRef|BNode:
+    #======================================
+        self.__expect('(')
+        head = RDF.nil
+        last = None
+        while self.__peek() != ')':
+            node = BNode()
+            if last is None:
+                head = node
+            else:
+                self.__triples.append((last, RDF.rest, node))
+            self.__triples.append((node, RDF.first, self.__term()))
+            last = node
+        self.__expect(')')
+        if last is not None:
+            self.__triples.append((last, RDF.rest, RDF.nil))
+        return head
+
+    def __term(self) -> URIRef|BNode|Literal:
+    #========================================
+        token = self.__peek()
+        if token == '[':
+            return self.__blank_node()
+        elif token == '(':
+            return self.__collection()
+        (kind, token) = self.__next()
+        if kind == 'string':
+            quotes = 3 if token[:3] in ['"""', "'''"] else 1
+            value = unescape(token[quotes:-quotes])
+            if self.__lookahead is not None and self.__lookahead[0] == 'at':
+                return Literal(value, lang=self.__next()[1][1:])
+            elif self.__peek() == '^^':
+                self.__next()
+                return Literal(value, datatype=self.__resource(self.__next()[1]))
+            return Literal(value)
+        elif kind == 'name':
+            if token in ['true', 'false']:
+                return Literal(token, datatype=XSD.boolean)
+            elif NUMBER.match(token):
+                datatype = (XSD.integer if token.lstrip('+-').isdigit()
+                       else XSD.double if 'e' in token.lower()
+                       else XSD.decimal)
+                return Literal(token, datatype=datatype)
+        return self.__resource(token)
+
+    def __resource(self, token: str) -> URIRef|BNode:
+    #================================================
+        if token.startswith('<'):
+            return URIRef(self.__iri(token))
+        elif token.startswith('_:'):
+            return BNode(token[2:])
+        (prefix, colon, local) = token.partition(':')
+        if colon == '' or prefix not in self.__prefixes:
+            raise ValueError(f"{self.__source}: unknown prefixed name '{token}'")
+        return URIRef(self.__prefixes[prefix] + re.sub(r'\\(.)', r'\1', local))
+
+    def __iri(self, token: str) -> str:
+    #==================================
+        iri = unescape(token[1:-1])
+        return urljoin(self.__base, iri) if self.__base else iri
+
+#===============================================================================
@@ -28,7 +28,7 @@ import os
 import queue
 import sys
 import threading
-from typing import Optional
+from typing import Callable, Optional
 import uuid
 
 #===============================================================================
@@ -190,9 +190,10 @@ class MakerProcess(multiprocessing.Process):
 
 class Manager(threading.Thread):
     """A thread to manage flatmap generation"""
-    def __init__(self):
+    def __init__(self, map_made: Optional[Callable[[dict], None]]=None):
         super().__init__(name='maker-thread')
         self.__log = settings['LOGGER']
+        self.__map_made = map_made
         self.__map_dir = None
         self.__processes_by_id: dict[str, MakerProcess] = {}
         self.__running_processes: list[str] = []
@@ -263,6 +264,11 @@ class Manager(threading.Thread):
                         info = ', '.join([ f'{key}: {value}' for key in MAKER_RESULT_KEYS
                                             if (value := maker_result.get(key)) is not None ])
                         self.__log.info(f'{status} mapmaker process: {process.name}, Map {info}')
+                        if self.__map_made is not None and 'uuid' in maker_result:
+                            try:
+                                self.__map_made(maker_result)
+                            except Exception as err:
+                                self.__log.exception(err)
                 self.__running_processes = still_running
             if len(self.__running_processes) == 0:
                 try:
@@ -0,0 +1,227 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import math
+import pathlib
+import sqlite3
+import threading
+from typing import Any, Iterator, Optional
+
+#===============================================================================
+
+from landez.sources import MBTilesReader, InvalidFormatError
+from landez.util import flip_y
+
+#===============================================================================
+
+from .settings import settings
+
+#===============================================================================
+
+"""
+Identifies a particular build of an ``mbtiles`` file: (inode, mtime, size)
+"""
+FileSignature = tuple[int, int, int]
+
+def file_signature(path: pathlib.Path) -> FileSignature:
+#=======================================================
+    stat = path.stat()
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+#===============================================================================
+
+@dataclass
+class TileMetadata:
+    """
+    Tile related values from an ``mbtiles`` file's ``metadata`` table
+    """
+    compressed: bool = False
+
+    @classmethod
+    def from_rows(cls, rows: dict[str, Any]) -> 'TileMetadata':
+    #===========================================================
+        return cls(compressed=bool(rows.get('compressed')))
+
+TILE_METADATA_NAMES = ['compressed']
+
+#===============================================================================
+
+"""
+A tile's (z, x, y) position, with ``y`` in XYZ (not TMS) order
+"""
+TileKey = tuple[int, int, int]
+
+# The latitude limit of Web Mercator tiles
+MAX_LATITUDE = 85.0511287798066
+
+def bounds_tile_range(zoom: int, bounds: list[float]) -> tuple[tuple[int, int], tuple[int, int]]:
+#================================================================================================
+    """
+    The inclusive ``x`` and ``y`` ranges of the tiles at a zoom level that cover
+    ``[west, south, east, north]`` bounds, given in degrees.
+    """
+    (west, south, east, north) = bounds
+    n = 2**zoom
+    def tile_x(longitude: float) -> int:
+        return min(n - 1, max(0, int((longitude + 180.0)/360.0*n)))
+    def tile_y(latitude: float) -> int:
+        latitude = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude)))
+        return min(n - 1, max(0, int((1.0 - math.asinh(math.tan(latitude))/math.pi)/2.0*n)))
+    return ((tile_x(west), tile_x(east)), (tile_y(north), tile_y(south)))
+
+#===============================================================================
+
+class PooledTilesReader(MBTilesReader):
+    """
+    A read-only ``MBTilesReader`` that keeps its SQLite connection open
+    and which can be shared by concurrent requests. Tile metadata is read
+    when the reader is opened.
+    """
+    def __init__(self, mbtiles: pathlib.Path, signature: FileSignature):
+        super().__init__(str(mbtiles))
+        self.__signature = signature
+        try:
+            self._con = sqlite3.connect(f'{mbtiles.resolve().as_uri()}?mode=ro',
+                                        uri=True, check_same_thread=False)
+        except sqlite3.Error as err:
+            raise InvalidFormatError(f'{err} while opening {mbtiles}')
+        try:
+            rows = self._query(f'''select name, value from metadata
+                                   where name in ({", ".join("?"*len(TILE_METADATA_NAMES))})''',
+                               TILE_METADATA_NAMES).fetchall()
+        except InvalidFormatError:
+            rows = []
+        self.__tile_metadata = TileMetadata.from_rows(dict(rows))
+
+    @property
+    def signature(self) -> FileSignature:
+        return self.__signature
+
+    @property
+    def tile_metadata(self) -> TileMetadata:
+        return self.__tile_metadata
+
+    def _query(self, sql, *args):
+    #============================
+        # Each query gets its own cursor as the connection is shared
+        try:
+            return self._con.execute(sql, *args)    # type: ignore
+        except sqlite3.Error as err:
+            raise InvalidFormatError(f'{err} while reading {self.filename}')
+
+    def tiles(self, tile_keys: list[TileKey]) -> list[tuple[TileKey, bytes]]:
+    #========================================================================
+        """
+        Read a number of tiles with a single query. Tiles that don't exist
+        are not returned.
+        """
+        if len(tile_keys) == 0:
+            return []
+        values = ', '.join(len(tile_keys)*['(?, ?, ?)'])
+        params = [value for (z, x, y) in tile_keys for value in (z, x, flip_y(y, z))]
+        rows = self._query(f'''select zoom_level, tile_column, tile_row, tile_data from tiles
+                               where (zoom_level, tile_column, tile_row) in (values {values})''',
+                           params).fetchall()
+        return [((z, x, flip_y(y, z)), tile_data) for (z, x, y, tile_data) in rows]
+
+    def tile_range(self, z: int, x_range: tuple[int, int], y_range: tuple[int, int]) -> list[tuple[TileKey, bytes]]:
+    #==============================================================================================================
+        """
+        Read all tiles within inclusive ``x`` and ``y`` ranges at a zoom level
+        with a single query.
+        """
+        rows = self._query('''select zoom_level, tile_column, tile_row, tile_data from tiles
+                              where zoom_level=? and tile_column between ? and ? and tile_row between ? and ?''',
+                           (z, x_range[0], x_range[1], flip_y(y_range[1], z), flip_y(y_range[0], z))).fetchall()
+        return [((z, x, flip_y(y, z)), tile_data) for (z, x, y, tile_data) in rows]
+
+    def metadata_size(self, name: str) -> Optional[tuple[int, Optional[int]]]:
+    #=========================================================================
+        """
+        The ``rowid`` and size in bytes of a ``metadata`` value.
+        """
+        return self._query('select rowid, length(cast(value as blob)) from metadata where name=?',
+                           (name,)).fetchone()
+
+    def raw_metadata(self, name: str) -> Optional[bytes]:
+    #====================================================
+        if (row := self._query('select cast(value as blob) from metadata where name=?', (name,)).fetchone()) is not None:
+            return row[0]
+
+    def stream_metadata(self, rowid: int, chunk_size: int=65536) -> Iterator[bytes]:
+    #===============================================================================
+        """
+        Read a ``metadata`` value incrementally, without loading all of it.
+        """
+        try:
+            with self._con.blobopen('metadata', 'value', rowid, readonly=True) as blob:   # type: ignore
+                while (chunk := blob.read(chunk_size)):
+                    yield chunk
+        except sqlite3.Error as err:
+            raise InvalidFormatError(f'{err} while reading {self.filename}')
+
+#===============================================================================
+
+class MBTilesPool:
+    """
+    A least-recently-used pool of open ``mbtiles`` readers, keyed by map
+    and layer. A reader is reopened when its file has been replaced by a
+    new map build.
+    """
+    def __init__(self, max_open: int):
+        self.__max_open = max(1, max_open)
+        self.__readers: OrderedDict[tuple[str, str], PooledTilesReader] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def reader(self, map_uuid: str, layer: str='index') -> PooledTilesReader:
+    #========================================================================
+        mbtiles = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / f'{layer}.mbtiles'
+        try:
+            signature = file_signature(mbtiles)
+        except OSError:
+            raise InvalidFormatError(f'Missing tile database: {mbtiles}')
+        key = (map_uuid, layer)
+        with self.__lock:
+            if (reader := self.__readers.get(key)) is not None and reader.signature == signature:
+                self.__readers.move_to_end(key)
+                return reader
+        reader = PooledTilesReader(mbtiles, signature)
+        with self.__lock:
+            self.__readers[key] = reader
+            self.__readers.move_to_end(key)
+            # An evicted reader is closed once requests using it release it
+            while len(self.__readers) > self.__max_open:
+                self.__readers.popitem(last=False)
+        return reader
+
+    def invalidate(self, map_uuid: str):
+    #===================================
+        with self.__lock:
+            for key in [key for key in self.__readers if key[0] == map_uuid]:
+                del self.__readers[key]
+
+#===============================================================================
+
+mbtiles_pool = MBTilesPool(settings['MBTILES_POOL_SIZE'])
+
+#===============================================================================
+#===============================================================================
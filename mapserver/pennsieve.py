@@ -18,13 +18,15 @@
 #
 #===============================================================================
 
-import json
+import asyncio
+import hashlib
 import os
+import time
 from typing import Any, Optional
 
 #===============================================================================
 
-import requests
+import httpx
 
 #===============================================================================
 
@@ -52,43 +54,126 @@ SPARC_ANNOTATION_TEAM_ID = os.environ.get('SPARC_ANNOTATION_TEAM_ID')
 
 #===============================================================================
 
-def query(url, method: str='GET') -> Any:
-    headers = {"accept": "*/*"}
-    response = requests.request(method, url, headers=headers)
-    if response.status_code == 200:
-        try:
-            return json.loads(response.text)
-        except requests.exceptions.JSONDecodeError:
-            pass
-    return {
-        'error': f'{response.status_code}: {response.reason}'
-    }
+# Seconds to wait for a response from Pennsieve
+
+PENNSIEVE_TIMEOUT = float(os.environ.get('PENNSIEVE_TIMEOUT', '10'))
+
+# How long, in seconds, the annotation team's members and users' details are
+# cached for
+
+TEAM_CACHE_TTL = 300
+USER_CACHE_TTL = 300
 
 #===============================================================================
 
-def get_annotation_team(key: str) -> Optional[list[str]]:
-    if SPARC_ORGANISATION_ID is None or SPARC_ORGANISATION_INT_ID is None or SPARC_ANNOTATION_TEAM_ID is None:
-        settings['LOGGER'].warning('Pennsieve IDs of SPARC and MAP Annotation Team are not defined')
-    try:
-        organization = query(f'{PENNSIEVE_API_ENDPOINT}/session/switch-organization?organization_id={SPARC_ORGANISATION_INT_ID}&api_key={key}', 'PUT')
-    except Exception as e:
-        settings['LOGGER'].warning(f"Failed to switch organization: {e}")
-    team_query = query(f'{PENNSIEVE_API_ENDPOINT}/organizations/{SPARC_ORGANISATION_ID}/teams/{SPARC_ANNOTATION_TEAM_ID}/members?api_key={key}')
-    if 'error' not in team_query:
-        return [id for member in team_query if (id := member.get('id')) is not None]
+class PennsieveClient:
+    """
+    An asynchronous client for the Pennsieve API that keeps connections open
+    and caches each API key's user details, along with the membership of
+    the annotation team.
+
+    A team's membership is cached by organisation and team, as it doesn't
+    depend on which user's key it was read with. Each user still has their
+    session switched to the SPARC organisation, so that their key can read
+    the team when the cached membership has expired.
+    """
+    def __init__(self, endpoint: str, timeout: float):
+        self.__endpoint = endpoint
+        self.__timeout = timeout
+        self.__client: Optional[httpx.AsyncClient] = None
+        self.__team_lock: Optional[asyncio.Lock] = None
+        self.__teams: dict[tuple[Optional[str], Optional[str]], tuple[float, list[str]]] = {}
+        self.__users: dict[str, tuple[float, dict]] = {}
+
+    async def close(self):
+    #=====================
+        """
+        Close the client's connections when the server shuts down.
+        """
+        if self.__client is not None:
+            await self.__client.aclose()
+            self.__client = None
+            self.__team_lock = None
+
+    async def get_user(self, key: str) -> dict:
+    #==========================================
+        user_key = hashlib.sha256(key.encode()).hexdigest()
+        now = time.monotonic()
+        if (cached := self.__users.get(user_key)) is not None and now < cached[0]:
+            return cached[1]
+        await self.__switch_organisation(key)
+        annotation_team = await self.__annotation_team(key)
+        user_query = await self.__query(f'/user/?api_key={key}')
+        if 'error' in user_query:
+            return user_query
+        user = {
+            'name': ' '.join([user_query.get('firstName', ''), user_query.get('lastName', '')]),
+            'email': user_query.get('email', ''),
+            'orcid': user_query.get('orcid', {}).get('orcid', ''),
+            'canUpdate': annotation_team is not None and user_query.get('id', '') in annotation_team
+        }
+        # Don't remember that a user can't update if we couldn't get the team
+        if annotation_team is not None:
+            self.__users = {user_key: entry for (user_key, entry) in self.__users.items() if now < entry[0]}
+            self.__users[user_key] = (now + USER_CACHE_TTL, user)
+        return user
+
+    async def __switch_organisation(self, key: str):
+    #===============================================
+        if SPARC_ORGANISATION_ID is None or SPARC_ORGANISATION_INT_ID is None or SPARC_ANNOTATION_TEAM_ID is None:
+            settings['LOGGER'].warning('Pennsieve IDs of SPARC and MAP Annotation Team are not defined')
+        organization = await self.__query(f'/session/switch-organization?organization_id={SPARC_ORGANISATION_INT_ID}&api_key={key}', 'PUT')
+        if 'error' in organization:
+            settings['LOGGER'].warning(f"Failed to switch organization: {organization['error']}")
+
+    async def __annotation_team(self, key: str) -> Optional[list[str]]:
+    #==================================================================
+        self.__connect()
+        team_key = (SPARC_ORGANISATION_ID, SPARC_ANNOTATION_TEAM_ID)
+        async with self.__team_lock:        # type: ignore
+            if (team := self.__teams.get(team_key)) is not None and time.monotonic() < team[0]:
+                return team[1]
+            team_query = await self.__query(f'/organizations/{SPARC_ORGANISATION_ID}/teams/{SPARC_ANNOTATION_TEAM_ID}/members?api_key={key}')
+            if 'error' in team_query:
+                return None
+            members = [id for member in team_query if (id := member.get('id')) is not None]
+            self.__teams[team_key] = (time.monotonic() + TEAM_CACHE_TTL, members)
+            return members
+
+    def __connect(self):
+    #===================
+        # The client and lock are created when first used, so that they
+        # belong to the server's event loop, and last until the server
+        # shuts down and calls ``close()``
+        if self.__client is None:
+            self.__client = httpx.AsyncClient(base_url=self.__endpoint, timeout=self.__timeout,
+                                              headers={'accept': '*/*'})
+            self.__team_lock = asyncio.Lock()
+
+    async def __query(self, url: str, method: str='GET') -> Any:
+    #===========================================================
+        self.__connect()
+        try:
+            response = await self.__client.request(method, url)     # type: ignore
+        except httpx.HTTPError as err:
+            return {
+                'error': f'{type(err).__name__}: {err}'
+            }
+        if response.status_code == 200:
+            try:
+                return response.json()
+            except ValueError:
+                pass
+        return {
+            'error': f'{response.status_code}: {response.reason_phrase}'
+        }
 
 #===============================================================================
 
-def get_user(key: str) -> dict:
-    annotation_team = get_annotation_team(key)
-    user_query = query(f'{PENNSIEVE_API_ENDPOINT}/user/?api_key={key}')
-    if 'error' in user_query:
-        return user_query
-    return {
-        'name': ' '.join([user_query.get('firstName', ''), user_query.get('lastName', '')]),
-        'email': user_query.get('email', ''),
-        'orcid': user_query.get('orcid', {}).get('orcid', ''),
-        'canUpdate': annotation_team is not None and user_query.get('id', '') in annotation_team
-    }
+pennsieve_client = PennsieveClient(PENNSIEVE_API_ENDPOINT, PENNSIEVE_TIMEOUT)
+
+async def get_user(key: str) -> dict:
+#====================================
+    return await pennsieve_client.get_user(key)
 
 #===============================================================================
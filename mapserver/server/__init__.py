@@ -38,15 +38,19 @@ from litestar.types import GetLogger
 
 from ..knowledge import KnowledgeStore
 from ..openapi import RapidocRenderPlugin
+from ..pennsieve import pennsieve_client
 from ..settings import settings
 from .. import __version__
 
-from .annotator import annotator_router
+from .annotator import annotation_broker, annotation_store, annotator_router
+from .catalogue import flatmap_catalogue
 from .connectivity import connectivity_router
 from .dashboard import dashboard_router
-from .flatmap import flatmap_router
+from .executor import executor_metrics, shutdown_executors
+from .flatmap import anatomical_hierarchy, flatmap_router
 from .knowledge import knowledge_router
 from .maker import maker_router, initialise as init_maker, terminate as end_maker
+from .sessions import annotator_sessions, session_store
 from .viewer import viewer_router
 
 #===============================================================================
@@ -84,6 +88,15 @@ def initialise(app: Litestar):
         logger.error('{}: {}'.format(knowledge_store.error, knowledge_store.db_name))
     knowledge_store.close()
 
+    # Load our catalogue of available flatmaps
+    flatmap_catalogue.start(settings['CATALOGUE_POLL_INTERVAL'])
+
+    # Start loading the hierarchy of anatomical terms, without waiting for it
+    anatomical_hierarchy.start()
+
+    # Open the store of annotator sessions
+    annotator_sessions.start(session_store(settings['ANNOTATOR_SESSION_STORE']))
+
     # If in viewer mode then add the viewer's routes
     if settings['MAP_VIEWER']:
         app.register(viewer_router)
@@ -93,8 +106,15 @@ def initialise(app: Litestar):
 
 #===============================================================================
 
-def terminate(app: Litestar):
+async def terminate(app: Litestar):
     end_maker()
+    flatmap_catalogue.terminate()
+    anatomical_hierarchy.terminate()
+    shutdown_executors()
+    annotator_sessions.terminate()
+    annotation_broker.terminate()
+    annotation_store.close()
+    await pennsieve_client.close()
     settings['LOGGER'].info(f'Shutdown flatmap server...')
 
 #===============================================================================
@@ -112,6 +132,16 @@ async def version() -> list[dict]:
 
 #===============================================================================
 
+@get('/metrics')
+async def metrics() -> list[dict]:
+    """
+    Queue depths and recent wait and run times, in milliseconds, of
+    the server's I/O thread pools.
+    """
+    return executor_metrics()
+
+#===============================================================================
+
 route_handlers = [
     annotator_router,
     connectivity_router,
@@ -119,6 +149,7 @@ route_handlers = [
     flatmap_router,
     knowledge_router,
     maker_router,
+    metrics,
     version
 ]
 
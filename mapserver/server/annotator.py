@@ -18,27 +18,36 @@
 #
 #===============================================================================
 
+import asyncio
+from collections import OrderedDict
+import contextlib
 import dataclasses
 from dataclasses import dataclass
 from datetime import datetime, timezone
 import json
+import logging
 import pathlib
+import queue
 import sqlite3
-from typing import Any, Optional
+import threading
+from typing import Any, AsyncIterator, Iterator, NamedTuple, Optional
 import uuid
+import zlib
 
 #===============================================================================
 
-from litestar import exceptions, get, post, Request, Response, Router
+from litestar import exceptions, get, MediaType, post, Request, Response, Router
 from litestar.middleware.session.server_side import ServerSideSessionConfig
+from litestar.response import ServerSentEvent, ServerSentEventMessage, Stream
 
 #===============================================================================
 
-if __name__ != '__main__':
-    from ..pennsieve import get_user as get_pennsieve_user
-    from ..settings import settings
-else:
-    settings = {}
+from ..pennsieve import get_user as get_pennsieve_user
+from ..settings import settings
+from ..utils import accepts_encoding
+from .executor import file_executor
+from .sessions import annotator_sessions
+from .subscriptions import AnnotationBroker
 
 #===============================================================================
 '''
@@ -101,18 +110,20 @@ TEST_USER = {
 '''
 #===============================================================================
 
-SCHEMA_VERSION = '1.1'
+SCHEMA_VERSION = '1.3'
 
-ANNOTATION_STORE_SCHEMA = """
-    begin;
+ANNOTATION_STORE_SCHEMA = f"""
     create table metadata (name text primary key, value text);
-    create table annotations (id text primary key, resource text, itemid text, item text, created text, orcid text, creator text, annotation text, status text);
+    create table annotations (id text primary key, resource text, itemid text, item text, created text, orcid text, creator text, annotation text, status text, seq integer);
     create index annotations_index on annotations(resource, itemid, created, orcid);
-    create table features (resource text, itemid text, deleted text, annotation text, feature text);
+    create index annotations_seq_index on annotations(resource, seq);
+    create index annotations_created_index on annotations(created, id);
+    create table features (resource text, itemid text, deleted text, annotation text, feature text, seq integer);
     create index features_index on features(resource, itemid, deleted);
     create index features_annotation_index on features(annotation, resource, itemid, deleted);
+    create index features_seq_index on features(resource, seq);
     insert into metadata (name, value) values ('schema_version', '{SCHEMA_VERSION}');
-    commit;
+    insert into metadata (name, value) values ('change_sequence', '0');
 """
 
 SCHEMA_UPGRADES: dict[Optional[str], tuple[str, str]] = {
@@ -123,57 +134,388 @@ SCHEMA_UPGRADES: dict[Optional[str], tuple[str, str]] = {
         update annotations set id = rowid;
         create table metadata (name text primary key, value text);
         replace into metadata (name, value) values ('schema_version', '1.1');
+    """),
+    # Databases were created without the schema version being substituted
+    '{SCHEMA_VERSION}': ('1.1', """
+        replace into metadata (name, value) values ('schema_version', '1.1');
+    """),
+    # Rows are stamped with the store's change sequence when added or changed;
+    # existing rows precede any change cursor
+    '1.1': ('1.2', """
+        alter table annotations add seq integer;
+        alter table features add seq integer;
+        update annotations set seq = 0;
+        update features set seq = 0;
+        create index annotations_seq_index on annotations(resource, seq);
+        create index features_seq_index on features(resource, seq);
+        replace into metadata (name, value) values ('change_sequence', '0');
+        replace into metadata (name, value) values ('schema_version', '1.2');
+    """),
+    # For paging through all annotations in order of creation
+    '1.2': ('1.3', """
+        create index annotations_created_index on annotations(created, id);
+        replace into metadata (name, value) values ('schema_version', '1.3');
     """)
 }
 
+# Seconds to wait for another connection to finish writing
+BUSY_TIMEOUT = 5.0
+
+# Number of prepared statements each connection keeps
+CACHED_STATEMENTS = 256
+
+# Number of annotations read at a time when downloading all annotations
+DOWNLOAD_PAGE_SIZE = 500
+
+# Number of annotations written in each transaction of a bulk import
+BULK_BATCH_SIZE = 500
+
+#===============================================================================
+
+class AnnotationDatabase:
+    """
+    Process-wide connections to an annotation database in write-ahead log
+    mode. Writes are serialised through a single connection and reads use a
+    pool of connections, so that reads don't wait for writes. Connections are
+    kept open and so reuse their prepared statements.
+
+    The database is created, or its schema upgraded, when first used.
+    """
+    def __init__(self, db_path: pathlib.Path, readers: int=4):
+        self.__db_path = db_path
+        self.__max_readers = max(1, readers)
+        self.__lock = threading.Lock()
+        self.__writer: Optional[sqlite3.Connection] = None
+        self.__write_lock = threading.Lock()
+        self.__readers: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self.__reader_count = 0
+
+    def close(self):
+    #===============
+        with self.__lock:
+            while not self.__readers.empty():
+                self.__readers.get_nowait().close()
+            self.__reader_count = 0
+            if self.__writer is not None:
+                self.__writer.close()
+                self.__writer = None
+
+    @contextlib.contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+    #================================================
+        self.__open()
+        try:
+            db = self.__readers.get_nowait()
+        except queue.Empty:
+            with self.__lock:
+                open_reader = self.__reader_count < self.__max_readers
+                if open_reader:
+                    self.__reader_count += 1
+            if open_reader:
+                try:
+                    db = self.__connect()
+                    db.execute('pragma query_only=1')
+                except BaseException:
+                    with self.__lock:
+                        self.__reader_count -= 1
+                    raise
+            else:
+                db = self.__readers.get()
+        try:
+            yield db
+        finally:
+            self.__readers.put(db)
+
+    @contextlib.contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+    #================================================
+        """
+        The writer connection, in a transaction that is committed on exit or
+        rolled back if there is an exception.
+        """
+        self.__open()
+        with self.__write_lock:
+            db: sqlite3.Connection = self.__writer      # type: ignore
+            db.execute('begin immediate')
+            try:
+                yield db
+            except BaseException:
+                db.execute('rollback')
+                raise
+            db.execute('commit')
+
+    def __connect(self) -> sqlite3.Connection:
+    #=========================================
+        db = sqlite3.connect(self.__db_path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                             check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        db.execute(f'pragma busy_timeout={int(1000*BUSY_TIMEOUT)}')
+        return db
+
+    def __open(self):
+    #================
+        if self.__writer is not None:
+            return
+        with self.__lock:
+            if self.__writer is None:
+                db = self.__connect()
+                db.execute('pragma journal_mode=WAL')
+                db.execute('pragma synchronous=NORMAL')
+                upgrade_schema(db)
+                self.__writer = db
+
+#===============================================================================
+
+def upgrade_schema(db: sqlite3.Connection):
+#==========================================
+    """
+    Create the annotation store's tables or upgrade their schema.
+
+    Each step is made in an immediate transaction which first checks the
+    schema version, so that server processes opening the database at the
+    same time don't each try to create or upgrade it.
+    """
+    while True:
+        schema_version: Optional[str] = None
+        db.execute('begin immediate')
+        try:
+            if db.execute("select count(*) from sqlite_schema where type='table'").fetchone()[0] == 0:
+                (schema_version, statements) = (SCHEMA_VERSION, ANNOTATION_STORE_SCHEMA)
+            else:
+                row = db.execute("select name from sqlite_schema where type='table' and name='metadata'").fetchone()
+                if row is not None:
+                    row = db.execute("select value from metadata where name='schema_version'").fetchone()
+                    if row is not None:
+                        schema_version = row[0]
+                if schema_version == SCHEMA_VERSION:
+                    db.execute('commit')
+                    return
+                if (upgrade := SCHEMA_UPGRADES.get(schema_version)) is None:
+                    raise ValueError(f'Unable to upgrade annotation schema from version {schema_version}')
+                logging.warning(f'Upgrading annotation schema from version {schema_version} to {upgrade[0]}')
+                (schema_version, statements) = upgrade
+            for statement in statements.split(';'):
+                if statement.strip():
+                    db.execute(statement)
+            db.execute('commit')
+        except sqlite3.Error as e:
+            db.execute('rollback')
+            raise ValueError(f'Unable to upgrade annotation schema to version {schema_version}: {str(e)}')
+        except ValueError:
+            db.execute('rollback')
+            raise
+
+#===============================================================================
+
+def features_json(resource_id: str, features: list[str], deleted_items: Optional[list[str]]=None) -> bytes:
+#=======================================================================================================
+    """
+    A resource's features as JSON, assembled from their stored JSON text
+    without parsing it.
+    """
+    parts = [b'{"resource": ', json.dumps(resource_id).encode(),
+             b', "features": [', ', '.join(features).encode(), b']']
+    if deleted_items is not None:
+        parts.extend([b', "deletedItems": ', json.dumps(deleted_items).encode()])
+    parts.append(b'}')
+    return b''.join(parts)
+
+"""
+Identifies the state of a resource's features: the number of current features
+and their largest ``rowid``. As feature rows are only ever added or flagged as
+deleted, this changes whenever a resource's features change.
+"""
+FeatureVersion = tuple[int, Optional[int]]
+
+class FeatureCache:
+    """
+    A least-recently-used cache of each resource's features, as JSON ready
+    to send, bounded by the total size of the cached values.
+    """
+    def __init__(self, max_bytes: int):
+        self.__max_bytes = max_bytes
+        self.__total_bytes = 0
+        self.__entries: OrderedDict[str, tuple[FeatureVersion, bytes]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, resource_id: str, version: FeatureVersion) -> Optional[bytes]:
+    #===========================================================================
+        with self.__lock:
+            if (entry := self.__entries.get(resource_id)) is not None and entry[0] == version:
+                self.__entries.move_to_end(resource_id)
+                return entry[1]
+
+    def set(self, resource_id: str, version: FeatureVersion, data: bytes):
+    #=====================================================================
+        if len(data) > self.__max_bytes//8:
+            return
+        with self.__lock:
+            self.__remove(resource_id)
+            self.__entries[resource_id] = (version, data)
+            self.__total_bytes += len(data)
+            while self.__total_bytes > self.__max_bytes:
+                (_, (_, evicted)) = self.__entries.popitem(last=False)
+                self.__total_bytes -= len(evicted)
+
+    def invalidate(self, resource_id: str):
+    #======================================
+        with self.__lock:
+            self.__remove(resource_id)
+
+    def __remove(self, resource_id: str):
+    #====================================
+        if (entry := self.__entries.pop(resource_id, None)) is not None:
+            self.__total_bytes -= len(entry[1])
+
+#===============================================================================
+
+class AnnotationRecord(NamedTuple):
+    """
+    An annotation checked and encoded ready for adding to the store.
+    """
+    id: str
+    resource: str
+    itemid: str
+    item: str
+    created: str
+    orcid: str
+    creator: str
+    annotation: str
+    status: Optional[str]
+    feature: Optional[str]
+
+def annotation_record(annotation: dict) -> AnnotationRecord|str:
+#===============================================================
+    """
+    Check an annotation to be imported, returning why if it is invalid.
+
+    An imported annotation keeps any ``annotationId``, ``created`` time and
+    ``status`` it has, as when copied from another server's download.
+    """
+    if not isinstance(annotation, dict):
+        return 'annotation must be a JSON object'
+    annotation = dict(annotation)
+    annotation_id = annotation.pop('annotationId', None)
+    if annotation_id is None:
+        annotation_id = str(uuid.uuid4())
+    elif not isinstance(annotation_id, str) or annotation_id == '':
+        return '`annotationId` must be a non-empty string'
+    created = annotation.pop('created', None)
+    if created is None:
+        created = datetime.now(tz=timezone.utc).isoformat(timespec='seconds')
+    elif not isinstance(created, str):
+        return '`created` must be a timestamp string'
+    resource_id = annotation.pop('resource', None)
+    if not resource_id or not isinstance(resource_id, str):
+        return 'a `resource` is required'
+    item = annotation.pop('item', None)
+    if not isinstance(item, dict):
+        item = {
+            'id': item
+        }
+    if not (item_id := item.get('id')) or not isinstance(item_id, str):
+        return 'an `item` is required'
+    creator = annotation.pop('creator', None)
+    if not isinstance(creator, dict) or not (orcid := creator.get('orcid')):
+        return 'a `creator` with an `orcid` is required'
+    creator = {key: value for (key, value) in creator.items() if key != 'canUpdate'}
+    feature = annotation.pop('feature', None)
+    status = annotation.pop('status', None)
+    return AnnotationRecord(annotation_id, resource_id, item_id, json.dumps(item), created, orcid,
+                            json.dumps(creator), json.dumps(annotation), status,
+                            json.dumps(feature) if feature and isinstance(feature, dict) else None)
+
 #===============================================================================
 
 class AnnotationStore:
     def __init__(self, db_path: Optional[pathlib.Path]=None):
         if db_path is None:
             db_path = pathlib.Path(settings['FLATMAP_ROOT']) / 'annotation_store.db'
-        # Create annotation store if it doesn't exist
-        db_name = db_path.resolve()
-        if not db_name.exists():
-            db = sqlite3.connect(db_name)
-            db.executescript(ANNOTATION_STORE_SCHEMA)
-            db.close()
-        self.__db = sqlite3.connect(db_name)
+        self.__database = AnnotationDatabase(db_path.resolve(), settings.get('ANNOTATION_DB_READERS', 1))
+        self.__feature_cache = FeatureCache(settings.get('FEATURE_CACHE_SIZE', 64)*1024*1024)
 
     @property
-    def db(self):
-        return self.__db
+    def database(self) -> AnnotationDatabase:
+        return self.__database
 
     def close(self):
     #===============
-        if self.__db is not None:
-            self.__db.close()
-            self.__db = None
-
-    def annotated_item_ids(self, resource_id: str) -> dict:
+        self.__database.close()
+
+    def change_cursor(self) -> int:
+    #==============================
+        """
+        The store's current change sequence. Rows added or changed after this
+        are those with a larger sequence number.
+
+        A cursor obtained before making a query will not miss any changes
+        when passed as ``since`` to a later query, although the later query
+        may repeat some of the earlier one's results.
+        """
+        with self.__database.reader() as db:
+            row = db.execute("select value from metadata where name='change_sequence'").fetchone()
+        return int(row[0]) if row is not None else 0
+
+    def __next_change(self, db: sqlite3.Connection) -> int:
     #======================================================
-        item_ids = []
-        if self.__db is not None:
+        return int(db.execute('''update metadata set value = cast(value as integer) + 1
+                                 where name='change_sequence' returning value''').fetchone()[0])
+
+    def resource_changes(self, resource_ids: list[str], since: int) -> tuple[int, dict[str, dict[str, Any]]]:
+    #=======================================================================================================
+        """
+        The current change cursor along with, for each of the resources with
+        changes after ``since``, the ids of its added or updated annotations
+        and the ids of items whose feature has changed.
+        """
+        changes: dict[str, dict[str, Any]] = {}
+        with self.__database.reader() as db:
+            db.execute('begin')
+            try:
+                row = db.execute("select value from metadata where name='change_sequence'").fetchone()
+                cursor = int(row[0]) if row is not None else 0
+                if cursor > since and len(resource_ids):
+                    resources = ', '.join('?'*len(resource_ids))
+                    for row in db.execute(f'''select resource, id from annotations
+                                              where resource in ({resources}) and seq > ?
+                                              order by seq''', (*resource_ids, since)):
+                        changes.setdefault(row[0], {'annotationIds': [], 'featureItemIds': []})['annotationIds'].append(row[1])
+                    for row in db.execute(f'''select distinct resource, itemid from features
+                                              where resource in ({resources}) and seq > ?
+                                              order by itemid''', (*resource_ids, since)):
+                        changes.setdefault(row[0], {'annotationIds': [], 'featureItemIds': []})['featureItemIds'].append(row[1])
+            finally:
+                db.execute('commit')
+        return (cursor, changes)
+
+    def annotated_item_ids(self, resource_id: str, since: Optional[int]=None) -> dict:
+    #=================================================================================
+        with self.__database.reader() as db:
             item_ids = [row[0]
-                        for row in self.__db.execute('''select distinct itemid
-                                                        from annotations where resource=?
-                                                         order by itemid''', (resource_id, ))
-                                            .fetchall()]
+                        for row in db.execute(f'''select distinct itemid
+                                                 from annotations where resource=?
+                                                  {"" if since is None else "and seq > ?"}
+                                                  order by itemid''',
+                                              (resource_id, ) if since is None else (resource_id, since))
+                                     .fetchall()]
         return {
             'resource': resource_id,
             'itemIds': item_ids
         }
 
-    def user_item_ids(self, resource_id: str, user_id: Optional[str], participated: bool) -> dict:
-    #=============================================================================================
+    def user_item_ids(self, resource_id: str, user_id: Optional[str], participated: bool,
+                      since: Optional[int]=None) -> dict:
+    #====================================================================================
         item_ids = []
-        if self.__db is not None and user_id is not None:
+        if user_id is not None:
             # Querying participated annotations if participated True, else non-participated annotations
-            item_ids = [row[0]
-                        for row in self.__db.execute(f'''select distinct itemid from annotations
-                                                         where resource=? and orcid {"=" if participated else "!="} ?
-                                                         order by itemid''', (resource_id, user_id))
-                                            .fetchall()]
+            with self.__database.reader() as db:
+                item_ids = [row[0]
+                            for row in db.execute(f'''select distinct itemid from annotations
+                                                      where resource=? and orcid {"=" if participated else "!="} ?
+                                                      {"" if since is None else "and seq > ?"}
+                                                      order by itemid''',
+                                                  (resource_id, user_id) if since is None else (resource_id, user_id, since))
+                                         .fetchall()]
         return {
             'resource': resource_id,
             'itemIds': item_ids,
@@ -181,160 +523,327 @@ class AnnotationStore:
             'participated': participated,
         }
 
-    def features(self, resource_id: str) -> dict:
-    #============================================
-        features = []
-        if self.__db is not None:
-            features = [json.loads(row[0])
-                           for row in self.__db.execute('''select feature from features
-                                                           where deleted is null and resource=?
-                                                           order by itemid''', (resource_id, ))
+    def features(self, resource_id: str) -> bytes:
+    #=============================================
+        """
+        A resource's features, as JSON. This is cached and only reassembled
+        after the resource's features change, including by another server
+        process.
+        """
+        with self.__database.reader() as db:
+            db.execute('begin')
+            try:
+                version = db.execute('''select count(*), max(rowid) from features
+                                        where deleted is null and resource=?''', (resource_id, )).fetchone()
+                if (data := self.__feature_cache.get(resource_id, version)) is not None:
+                    return data
+                features = [row[0] for row in db.execute('''select feature from features
+                                                            where deleted is null and resource=?
+                                                            order by itemid''', (resource_id, ))
                                                 .fetchall()]
-        return {
-            'resource': resource_id,
-            'features': features
-        }
-
-    def item_features(self, resource_id: str, item_ids: list[str]) -> dict:
-    #======================================================================
+            finally:
+                db.execute('commit')
+        data = features_json(resource_id, features)
+        self.__feature_cache.set(resource_id, version, data)
+        return data
+
+    def item_features(self, resource_id: str, item_ids: list[str]) -> bytes:
+    #=======================================================================
         features = []
-        if self.__db is not None and len(item_ids):
-            features = [json.loads(row[0])
-                for row in self.__db.execute(f'''select feature from features
-                                                 where deleted is null and resource=?
-                                                       and itemid in ({", ".join("?"*len(item_ids))})
-                                                 order by itemid''', (resource_id, *item_ids))
-                                    .fetchall()]
-        return {
-            'resource': resource_id,
-            'features': features
-        }
-
-    def annotations(self, resource_id: Optional[str]=None, item_id: Optional[str]=None) -> list[dict]:
+        if len(item_ids):
+            with self.__database.reader() as db:
+                features = [row[0]
+                    for row in db.execute(f'''select feature from features
+                                              where deleted is null and resource=?
+                                                    and itemid in ({", ".join("?"*len(item_ids))})
+                                              order by itemid''', (resource_id, *item_ids))
+                                 .fetchall()]
+        return features_json(resource_id, features)
+
+    def changed_features(self, resource_id: str, since: int, item_ids: Optional[list[str]]=None) -> bytes:
+    #=====================================================================================================
+        """
+        A resource's features that have been added since a change cursor,
+        along with the ids of items whose feature has since been removed.
+        """
+        item_clause = ''
+        item_values = ()
+        if item_ids is not None:
+            item_clause = f'and itemid in ({", ".join("?"*len(item_ids))})'
+            item_values = tuple(item_ids)
+        with self.__database.reader() as db:
+            db.execute('begin')
+            try:
+                features = [row[0]
+                    for row in db.execute(f'''select feature from features
+                                              where deleted is null and resource=? and seq > ? {item_clause}
+                                              order by itemid''', (resource_id, since, *item_values))
+                                 .fetchall()]
+                deleted_items = [row[0]
+                    for row in db.execute(f'''select distinct itemid from features as f
+                                              where deleted is not null and resource=? and seq > ? {item_clause}
+                                                and not exists (select 1 from features
+                                                                where deleted is null and resource=f.resource
+                                                                  and itemid=f.itemid)
+                                              order by itemid''', (resource_id, since, *item_values))
+                                 .fetchall()]
+            finally:
+                db.execute('commit')
+        return features_json(resource_id, features, deleted_items)
+
+    def annotations(self, resource_id: Optional[str]=None, item_id: Optional[str]=None,
+                    since: Optional[int]=None) -> list[dict]:
     #=================================================================================================
         annotations = []
-        if self.__db is not None:
-            where_values = []
-            if resource_id is None:
-                where_statement =  ''
-            else:
-                where_clauses = ['resource=?']
-                where_values.append(resource_id)
-                if item_id is not None:
-                    where_clauses.append('itemid=?')
-                    where_values.append(item_id)
-                where_statement = 'where ' + ' and '.join(where_clauses)
-            for row in self.__db.execute(f'''select id, created, creator, annotation, resource, itemid, item, status
-                                        from annotations {where_statement}
-                                        order by created desc, creator''',
-                                    tuple(where_values)).fetchall():
-                annotation = {
-                    'annotationId': row[0],
-                    'resource': row[4],
-                    'item': json.loads(row[6]),
-                    'created': row[1],
-                    'creator': json.loads(row[2]),
-                    'status': row[7]
-                }
-                annotation.update(json.loads(row[3]))
-                annotations.append(annotation)
+        where_clauses = []
+        where_values = []
+        if resource_id is not None:
+            where_clauses.append('resource=?')
+            where_values.append(resource_id)
+            if item_id is not None:
+                where_clauses.append('itemid=?')
+                where_values.append(item_id)
+        if since is not None:
+            where_clauses.append('seq > ?')
+            where_values.append(since)
+        where_statement = ('where ' + ' and '.join(where_clauses)) if where_clauses else ''
+        with self.__database.reader() as db:
+            rows = db.execute(f'''select id, created, creator, annotation, resource, itemid, item, status
+                                  from annotations {where_statement}
+                                  order by created desc, creator''',
+                              tuple(where_values)).fetchall()
+        for row in rows:
+            annotations.append(self.__annotation_from_row(row))
         return annotations
 
+    def annotations_page(self, before: Optional[tuple[str, str]]=None, since: Optional[int]=None,
+                         limit: int=DOWNLOAD_PAGE_SIZE) -> list[dict]:
+    #=============================================================================================
+        """
+        A page of all annotations, newest first.
+
+        :param before: the ``created`` time and ``annotationId`` of the last
+                       annotation on the previous page
+        :param since: only annotations changed after this change cursor
+        :param limit: the maximum number of annotations to return
+        """
+        where_clauses = []
+        where_values: list[Any] = []
+        if before is not None:
+            where_clauses.append('(created, id) < (?, ?)')
+            where_values.extend(before)
+        if since is not None:
+            where_clauses.append('seq > ?')
+            where_values.append(since)
+        where_statement = ('where ' + ' and '.join(where_clauses)) if where_clauses else ''
+        with self.__database.reader() as db:
+            rows = db.execute(f'''select id, created, creator, annotation, resource, itemid, item, status
+                                  from annotations {where_statement}
+                                  order by created desc, id desc limit ?''',
+                              (*where_values, limit)).fetchall()
+        return [self.__annotation_from_row(row) for row in rows]
+
+    @staticmethod
+    def __annotation_from_row(row: tuple) -> dict:
+    #=============================================
+        annotation = {
+            'annotationId': row[0],
+            'resource': row[4],
+            'item': json.loads(row[6]),
+            'created': row[1],
+            'creator': json.loads(row[2]),
+            'status': row[7]
+        }
+        annotation.update(json.loads(row[3]))
+        return annotation
+
     def annotation(self, annotation_id: str) -> dict:
     #================================================
         annotation = {}
-        if self.__db is not None:
-            row = self.__db.execute('''select a.resource, a.itemid, a.item, a.created, a.creator, a.annotation, a.status, f.feature
-                                        from annotations as a left join features as f on a.id = f.annotation
-                                        where a.id=? and f.deleted is null''', (annotation_id, )).fetchone()
-            if row is not None:
-                annotation = {
-                    'annotationId': annotation_id,
-                    'resource': row[0],
-                    'item': json.loads(row[2]),
-                    'created': row[3],
-                    'creator': json.loads(row[4]),
-                    'status': row[6],
-                    'feature': json.loads(row[7]) if row[7] else None,
-                }
-                annotation.update(json.loads(row[5]))
+        with self.__database.reader() as db:
+            row = db.execute('''select a.resource, a.itemid, a.item, a.created, a.creator, a.annotation, a.status, f.feature
+                                from annotations as a left join features as f on a.id = f.annotation
+                                where a.id=? and f.deleted is null''', (annotation_id, )).fetchone()
+        if row is not None:
+            annotation = {
+                'annotationId': annotation_id,
+                'resource': row[0],
+                'item': json.loads(row[2]),
+                'created': row[3],
+                'creator': json.loads(row[4]),
+                'status': row[6],
+                'feature': json.loads(row[7]) if row[7] else None,
+            }
+            annotation.update(json.loads(row[5]))
         return annotation
 
     def add_annotation(self, annotation: dict) -> dict[str, Any]:
     #============================================================
         result = {}
-        if self.__db is not None:
-            created = annotation.pop('created', None)
-            if created is None:
-                created = datetime.now(tz=timezone.utc).isoformat(timespec='seconds')
-            creator = annotation.pop('creator', None)
-            resource_id = annotation.pop('resource', None)
-            item = annotation.pop('item', None)
-            if not isinstance(item, dict):
-                item = {
-                    'id': item
-                }
-            item_id = item['id']
-            if (resource_id and item_id
-            and creator and (orcid := creator.get('orcid'))):
-                creator.pop('canUpdate', None)
-                try:
-                    feature = annotation.pop('feature', None)
-                    status = annotation.pop('status', None)
-                    annotation_id = str(uuid.uuid4())
-                    result['annotationId'] = annotation_id
-                    cursor = self.__db.cursor()
-                    cursor.execute('''insert into annotations
-                        (id, resource, itemid, item, created, orcid, creator, annotation, status) values (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        created = annotation.pop('created', None)
+        if created is None:
+            created = datetime.now(tz=timezone.utc).isoformat(timespec='seconds')
+        creator = annotation.pop('creator', None)
+        resource_id = annotation.pop('resource', None)
+        item = annotation.pop('item', None)
+        if not isinstance(item, dict):
+            item = {
+                'id': item
+            }
+        item_id = item['id']
+        if (resource_id and item_id
+        and creator and (orcid := creator.get('orcid'))):
+            creator.pop('canUpdate', None)
+            try:
+                feature = annotation.pop('feature', None)
+                status = annotation.pop('status', None)
+                annotation_id = str(uuid.uuid4())
+                with self.__database.writer() as db:
+                    seq = self.__next_change(db)
+                    db.execute('''insert into annotations
+                        (id, resource, itemid, item, created, orcid, creator, annotation, status, seq) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
                         (annotation_id, resource_id, item_id, json.dumps(item), created, orcid,
-                         json.dumps(creator), json.dumps(annotation), status))
+                         json.dumps(creator), json.dumps(annotation), status, seq))
                     # Flag as deleted any non-deleted entries for the feature
-                    cursor.execute('''update features set deleted=?
+                    db.execute('''update features set deleted=?, seq=?
                         where deleted is null and resource=? and itemid=?''',
-                        (annotation_id, resource_id, item_id))
+                        (annotation_id, seq, resource_id, item_id))
                     if feature and isinstance(feature, dict):
                         # Add a new row when we have a new feature
-                        cursor.execute('''insert into features
-                            (resource, itemid, annotation, deleted, feature) values (?, ?, ?, null, ?)''',
-                            (resource_id, item_id, annotation_id, json.dumps(feature)))
-                    cursor.execute('commit')
-                except sqlite3.OperationalError as err:
-                    result['error'] = str(err)
-        else:
-            result['error'] = 'No annotation database...'
+                        db.execute('''insert into features
+                            (resource, itemid, annotation, deleted, feature, seq) values (?, ?, ?, null, ?, ?)''',
+                            (resource_id, item_id, annotation_id, json.dumps(feature), seq))
+                self.__feature_cache.invalidate(resource_id)
+                result['annotationId'] = annotation_id
+            except sqlite3.OperationalError as err:
+                result['error'] = str(err)
         return result
 
-    def update_status(self, annotation_id: str, status: str) -> dict[str, Any]:
-    #==========================================================================
+    def add_annotations(self, annotations: list[Any], first_index: int=0) -> list[dict[str, Any]]:
+    #==============================================================================================
+        """
+        Add a batch of annotations, as if each were added by ``add_annotation``
+        in turn, but in a single transaction.
+
+        :param annotations: the annotations to add
+        :param first_index: the position of the first annotation in an import,
+                            used to identify results
+        :returns: a result for each annotation, with either its ``annotationId``
+                  or an ``error``
+        """
+        invalid: list[dict[str, Any]] = []
+        records: list[tuple[int, AnnotationRecord]] = []
+        for (index, annotation) in enumerate(annotations, start=first_index):
+            record = annotation_record(annotation)
+            if isinstance(record, str):
+                invalid.append({'index': index, 'error': record})
+            else:
+                records.append((index, record))
+        results = list(invalid)
+        if len(records) == 0:
+            return sorted(results, key=lambda result: result['index'])
+        added: list[tuple[int, AnnotationRecord]] = []
+        try:
+            with self.__database.writer() as db:
+                existing = set()
+                for start in range(0, len(records), BULK_BATCH_SIZE):
+                    ids = [record.id for (_, record) in records[start:start+BULK_BATCH_SIZE]]
+                    existing.update(row[0] for row in db.execute(
+                        f'select id from annotations where id in ({", ".join("?"*len(ids))})', ids))
+                for (index, record) in records:
+                    if record.id in existing:
+                        results.append({'index': index, 'error': 'annotation already exists',
+                                        'annotationId': record.id})
+                    else:
+                        existing.add(record.id)
+                        added.append((index, record))
+                # A change is only made when there are annotations to add
+                if len(added):
+                    seq = self.__next_change(db)
+                    group: list[AnnotationRecord] = []
+                    group_items = set()
+                    for (_, record) in added:
+                        # Features must be replaced in order when an item is annotated
+                        # more than once
+                        if (record.resource, record.itemid) in group_items:
+                            self.__write_annotations(db, group, seq)
+                            group = []
+                            group_items = set()
+                        group.append(record)
+                        group_items.add((record.resource, record.itemid))
+                    self.__write_annotations(db, group, seq)
+        except sqlite3.Error as err:
+            # Nothing in the batch has been added
+            results = invalid + [{'index': index, 'error': str(err)} for (index, _) in records]
+            return sorted(results, key=lambda result: result['index'])
+        for resource_id in {record.resource for (_, record) in added}:
+            self.__feature_cache.invalidate(resource_id)
+        results.extend({'index': index, 'annotationId': record.id} for (index, record) in added)
+        return sorted(results, key=lambda result: result['index'])
+
+    @staticmethod
+    def __write_annotations(db: sqlite3.Connection, records: list[AnnotationRecord], seq: int):
+    #==========================================================================================
+        db.executemany('''insert into annotations
+            (id, resource, itemid, item, created, orcid, creator, annotation, status, seq) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(*record[:9], seq) for record in records])
+        db.executemany('''update features set deleted=?, seq=?
+            where deleted is null and resource=? and itemid=?''',
+            [(record.id, seq, record.resource, record.itemid) for record in records])
+        db.executemany('''insert into features
+            (resource, itemid, annotation, deleted, feature, seq) values (?, ?, ?, null, ?, ?)''',
+            [(record.resource, record.itemid, record.id, record.feature, seq)
+                for record in records if record.feature is not None])
+
+    def update_status(self, annotation_id: str, status: str) -> Optional[dict[str, Any]]:
+    #====================================================================================
+        """
+        Set an annotation's status.
+
+        :returns: ``None`` if there is no such annotation, otherwise a result
+                  with either ``success`` or an ``error``
+        """
         result = {}
-        if self.__db is not None:
-            try:
-                cursor = self.__db.cursor()
-                cursor.execute('update annotations set status=? where id=', (annotation_id, status))
-                result['success'] = 'status updated'
-            except sqlite3.OperationalError as err:
-                result['error'] = str(err)
-        else:
-            result['error'] = 'No annotation database...'
+        try:
+            with self.__database.writer() as db:
+                # A change is only made when the annotation exists
+                if db.execute('select 1 from annotations where id=?', (annotation_id,)).fetchone() is None:
+                    return None
+                db.execute('update annotations set status=?, seq=? where id=?',
+                           (status, self.__next_change(db), annotation_id))
+            result['success'] = 'status updated'
+        except sqlite3.OperationalError as err:
+            result['error'] = str(err)
         return result
 
 #===============================================================================
 
-__sessions: dict[str, dict] = {}
+if __name__ != '__main__':
+    # The server's annotation store, opened when first used
+    annotation_store = AnnotationStore()
+
+    # Pushes changes to the subscribers of annotated resources
+    annotation_broker = AnnotationBroker(annotation_store.resource_changes,
+                                         annotation_store.change_cursor,
+                                         settings['ANNOTATION_POLL_INTERVAL'])
+
+#===============================================================================
 
 def __session_key(key: str) -> str:
     return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
 
 def __new_session(key: str, data: dict) -> str:
     session_key = __session_key(key)
-    __sessions[session_key] = data
+    annotator_sessions.new(session_key, data)
     return session_key
 
 def __session_data(session_key: str) -> Optional[dict]:
-    return __sessions.get(session_key)
+    # A session that has ended or expired stays so, even though its key
+    # would give the same session key if authenticated again
+    return annotator_sessions.get(session_key)
 
 def __del_session(session_key: str) -> bool:
-    return __sessions.pop(session_key, None) is not None
+    return annotator_sessions.delete(session_key)
 
 #===============================================================================
 
@@ -345,16 +854,35 @@ def __get_json_parameter(query: dict[str, Any], key: str, default: Any=None) ->
         except json.decoder.JSONDecodeError:
             pass
 
+# Clients poll for changes by passing the cursor from this header as ``since``
+
+CURSOR_HEADER = 'X-Annotation-Cursor'
+
+# Annotations are downloaded and imported as JSON arrays or as newline-delimited JSON
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+def __get_since(query: dict[str, Any]) -> Optional[int]:
+    if query.get('since') is None:
+        return None
+    since = __get_json_parameter(query, 'since')
+    if not isinstance(since, int) or isinstance(since, bool):
+        raise exceptions.ValidationException('`since` must be an integer change cursor')
+    return since
+
+def __cursor_response(content: Any, cursor: int, media_type: str=MediaType.JSON) -> Response:
+    return Response(content=content, media_type=media_type, headers={CURSOR_HEADER: str(cursor)})
+
 #===============================================================================
 #===============================================================================
 
-def __authenticated_session(query: dict[str, Any], request: Request) -> bool:
-#============================================================================
+async def __authenticated_session(query: dict[str, Any], request: Request) -> bool:
+#==================================================================================
     request.session['update'] = False
     if ((key := query.get('key')) is not None
       and (session_key := query.get('session')) is not None
       and session_key == __session_key(key)
-      and (data := __session_data(session_key)) is not None):
+      and (data := await file_executor.run(__session_data, session_key)) is not None):
         request.session['update'] = data.get('canUpdate', False)
         return True
     return False
@@ -374,9 +902,9 @@ def __authenticated_bearer(request: Request) -> bool:
 @get('authenticate')
 async def annotator_authenticate(query: dict[str, Any]) -> dict|Response:
     if (key := query.get('key')) is not None:
-        user_data = get_pennsieve_user(key)     # type: ignore
+        user_data = await get_pennsieve_user(key)     # type: ignore
         if 'error' not in user_data:
-            session_key = __new_session(key, user_data)
+            session_key = await file_executor.run(__new_session, key, user_data)
             response = {
                 'session': session_key,
                 'data': user_data
@@ -392,57 +920,71 @@ async def annotator_authenticate(query: dict[str, Any]) -> dict|Response:
 @get('unauthenticate')
 async def annotator_unauthenticate(query: dict[str, Any], request: Request) -> dict:
     if (session := query.get('session')) is not None:
-        __del_session(session)
+        await file_executor.run(__del_session, session)
         request.session['update'] = False
     return {"success": "Unauthenticated"}
 
 #===============================================================================
 
+# Annotation store calls block and so are run by the file executor
+
+def __annotated_items(resource_id: str, user_id: Optional[str], participated: bool, since: Optional[int]) -> Response:
+    cursor = annotation_store.change_cursor()
+    if user_id is not None:
+        item_ids = annotation_store.user_item_ids(resource_id, user_id, participated, since)
+    else:
+        item_ids = annotation_store.annotated_item_ids(resource_id, since)
+    return __cursor_response(item_ids, cursor)
+
 @get('items/')
-async def annotator_annotated_items(query: dict[str, Any], request: Request) -> dict:
-    if __authenticated_session(query, request):
+async def annotator_annotated_items(query: dict[str, Any], request: Request) -> dict|Response:
+    if await __authenticated_session(query, request):
         if (resource_id := __get_json_parameter(query, 'resource')) is not None:
+            since = __get_since(query)
             user_id = __get_json_parameter(query, 'user')
-            annotation_store = AnnotationStore()
-            if user_id is not None:
-                participated = __get_json_parameter(query, 'participated', True)
-                item_ids = annotation_store.user_item_ids(resource_id, user_id, participated)
-            else:
-                item_ids = annotation_store.annotated_item_ids(resource_id)
-            annotation_store.close()
-            return item_ids
+            participated = __get_json_parameter(query, 'participated', True) if user_id is not None else True
+            return await file_executor.run(__annotated_items, resource_id, user_id, participated, since)
         return {}
     raise exceptions.NotAuthorizedException()
 
 #===============================================================================
 
+def __annotated_features(resource_id: str, item_ids: Optional[list[str]], since: Optional[int]) -> Response:
+    cursor = annotation_store.change_cursor()
+    if since is not None:
+        features = annotation_store.changed_features(resource_id, since, item_ids)
+    elif item_ids is not None:
+        features = annotation_store.item_features(resource_id, item_ids)
+    else:
+        features = annotation_store.features(resource_id)
+    # Features are already encoded as JSON
+    return __cursor_response(features, cursor)
+
 @get('features/')
-async def annotator_features(query: dict[str, Any], request: Request) -> dict:
-    if __authenticated_session(query, request):
+async def annotator_features(query: dict[str, Any], request: Request) -> dict|Response:
+    if await __authenticated_session(query, request):
         if (resource_id := __get_json_parameter(query, 'resource')) is not None:
-            annotation_store = AnnotationStore()
+            since = __get_since(query)
             if (item_ids := __get_json_parameter(query, 'items')) is not None:
                 if isinstance(item_ids, str):
                     item_ids = [item_ids]
-                features = annotation_store.item_features(resource_id, item_ids)
-            else:
-                features = annotation_store.features(resource_id)
-            annotation_store.close()
-            return features
+            return await file_executor.run(__annotated_features, resource_id, item_ids, since)
         return {}
     raise exceptions.NotAuthorizedException()
 
 #===============================================================================
 
+def __item_annotations(resource_id: str, item_id: str, since: Optional[int]) -> Response:
+    cursor = annotation_store.change_cursor()
+    return __cursor_response(annotation_store.annotations(resource_id, item_id, since), cursor)
+
 @get('annotations/')
-async def annotator_annotations(query: dict[str, Any], request: Request) -> list[dict]:
-    if __authenticated_session(query, request):
+async def annotator_annotations(query: dict[str, Any], request: Request) -> list[dict]|Response:
+    if await __authenticated_session(query, request):
         if ((resource_id := __get_json_parameter(query, 'resource')) is not None
         and (item_id := __get_json_parameter(query, 'item')) is not None):
-            annotation_store = AnnotationStore()
-            annotations = annotation_store.annotations(resource_id, item_id)
-            annotation_store.close()
-            return annotations
+            since = __get_since(query)
+            return await file_executor.run(__item_annotations, resource_id, item_id, since)
         return []
     raise exceptions.NotAuthorizedException()
 
@@ -450,12 +992,9 @@ async def annotator_annotations(query: dict[str, Any], request: Request) -> list
 
 @get(['annotation/', 'annotation/<str:id>'])
 async def annotator_annotation(query: dict[str, Any], request: Request, id: Optional[str]=None) -> dict:
-    if __authenticated_session(query, request):
+    if await __authenticated_session(query, request):
         annotation_id = __get_json_parameter(query, 'annotation', '') if id is None else id
-        annotation_store = AnnotationStore()
-        annotation = annotation_store.annotation(annotation_id)
-        annotation_store.close()
-        return annotation
+        return await file_executor.run(annotation_store.annotation, annotation_id)
     raise exceptions.NotAuthorizedException()
 
 #===============================================================================
@@ -470,11 +1009,10 @@ class AnnotationUpdateRequest:
 
 @post('annotation/')
 async def annotator_add_annotation(data: AnnotationUpdateRequest, request: Request) -> dict|Response:
-    if __authenticated_session(dataclasses.asdict(data), request):
+    if await __authenticated_session(dataclasses.asdict(data), request):
         if request.session['update']:
-            annotation_store = AnnotationStore()
-            result = annotation_store.add_annotation(data.data)
-            annotation_store.close()
+            result = await file_executor.run(annotation_store.add_annotation, data.data)
+            annotation_broker.notify()
         else:
             result = Response(content={'error': 'forbidden'}, status_code=403)
         return result
@@ -484,16 +1022,18 @@ async def annotator_add_annotation(data: AnnotationUpdateRequest, request: Reque
 
 @post('update/')
 async def annotator_update_status(data: AnnotationUpdateRequest, request: Request) -> dict|Response:
-    if __authenticated_session(dataclasses.asdict(data), request) or __authenticated_bearer(request):
+    if await __authenticated_session(dataclasses.asdict(data), request) or __authenticated_bearer(request):
         if request.session['update']:
-            annotation_store = AnnotationStore()
             annotation_id = data.data.get('annotationId')
             status = data.data.get('status')
             if annotation_id is not None and status is not None:
-                result = annotation_store.update_status(annotation_id, status)
+                result = await file_executor.run(annotation_store.update_status, annotation_id, status)
+                if result is None:
+                    result = Response(content={'error': 'unknown annotation'}, status_code=404)
+                elif 'success' in result:
+                    annotation_broker.notify()
             else:
                 result = Response(content={'error': 'invalid parameters'}, status_code=400)
-            annotation_store.close()
         else:
             result = Response(content={'error': 'forbidden'}, status_code=403)
         return result
@@ -501,13 +1041,180 @@ async def annotator_update_status(data: AnnotationUpdateRequest, request: Reques
 
 #===============================================================================
 
+def __authenticated_importer(request: Request) -> bool:
+#======================================================
+    (scheme, _, token) = request.headers.get('Authorization', '').partition(' ')
+    token = token.strip()
+    return (scheme == 'Bearer' and token != ''
+        and token in settings['ANNOTATOR_TOKENS']
+        and token in settings['ANNOTATOR_UPDATE'])
+
+def __parse_json_line(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except json.decoder.JSONDecodeError:
+        return line
+
+@post('bulk/', status_code=200)
+async def annotator_bulk_add(query: dict[str, Any], request: Request) -> dict|Response:
+    """
+    Import annotations, either as a JSON array or, with a ``Content-Type`` of
+    ``application/x-ndjson``, as newline-delimited JSON.
+
+    Annotations are checked and added in batches, each in a single transaction.
+    An annotation keeps any ``annotationId``, ``created`` time and ``status``
+    it has, so that annotations downloaded from one server can be imported
+    by another, and one that already exists isn't added again.
+
+    Requires either ``key`` and ``session`` query parameters of a user who
+    can update annotations, or a bearer token in ``ANNOTATOR_UPDATE``.
+
+    :>json int added: the number of annotations added
+    :>json int errors: the number of annotations not added
+    :>json list results: for each annotation, its ``index`` in the import
+                         along with either its ``annotationId`` or an ``error``
+    """
+    if await __authenticated_session(query, request):
+        if not request.session['update']:
+            return Response(content={'error': 'forbidden'}, status_code=403)
+    elif not __authenticated_importer(request):
+        raise exceptions.NotAuthorizedException()
+    results = []
+    if NDJSON_MEDIA_TYPE in request.headers.get('content-type', ''):
+        # Add annotations as they arrive rather than after reading them all
+        batch = []
+        buffer = b''
+        async for chunk in request.stream():
+            buffer += chunk
+            (*lines, buffer) = buffer.split(b'\n')
+            for line in lines:
+                if line.strip():
+                    batch.append(__parse_json_line(line))
+                if len(batch) == BULK_BATCH_SIZE:
+                    results.extend(await file_executor.run(annotation_store.add_annotations, batch, len(results)))
+                    batch = []
+        if buffer.strip():
+            batch.append(__parse_json_line(buffer))
+        if len(batch):
+            results.extend(await file_executor.run(annotation_store.add_annotations, batch, len(results)))
+    else:
+        try:
+            annotations = json.loads(await request.body())
+        except json.decoder.JSONDecodeError:
+            annotations = None
+        if not isinstance(annotations, list):
+            return Response(content={'error': 'a JSON array of annotations is expected'}, status_code=400)
+        for start in range(0, len(annotations), BULK_BATCH_SIZE):
+            results.extend(await file_executor.run(annotation_store.add_annotations,
+                                                   annotations[start:start+BULK_BATCH_SIZE], start))
+    errors = sum(1 for result in results if 'error' in result)
+    if len(results) > errors:
+        annotation_broker.notify()
+    return {
+        'added': len(results) - errors,
+        'errors': errors,
+        'results': results
+    }
+
+#===============================================================================
+
+# Seconds between comments sent to keep an idle subscription open
+
+SUBSCRIPTION_KEEPALIVE = 20
+
+# Just a comment line, which clients ignore, and not an empty ``message`` event
+
+KEEPALIVE_MESSAGE = ServerSentEventMessage(comment='keepalive', data=None)
+
+async def __subscription_events(resource_id: str, since: Optional[int]) -> AsyncIterator[ServerSentEventMessage]:
+    # Subscribing only once the response has started means nothing is left
+    # registered if the client goes away before then
+    subscription = await annotation_broker.subscribe(resource_id, since)
+    try:
+        while True:
+            try:
+                event = await subscription.get(SUBSCRIPTION_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield KEEPALIVE_MESSAGE
+                continue
+            if event is None:
+                break
+            yield ServerSentEventMessage(data=json.dumps(event[1]), event=event[0], id=event[1]['cursor'])
+    finally:
+        annotation_broker.unsubscribe(subscription)
+
+@get('subscribe/')
+async def annotator_subscribe(query: dict[str, Any], request: Request) -> ServerSentEvent:
+    """
+    Subscribe to changes to a resource's annotations, as Server-Sent Events.
+
+    A ``changes`` event is sent when annotations are added to the resource or
+    have their status changed, with the ids of the annotations along with the
+    ids of items whose feature has changed, and the change cursor to use as
+    ``since`` when fetching them. A ``reset`` event means that changes were
+    made faster than they could be sent and should be fetched using the last
+    cursor received. Changes after an initial ``since`` cursor are sent first.
+    """
+    if await __authenticated_session(query, request):
+        if (resource_id := __get_json_parameter(query, 'resource')) is not None:
+            return ServerSentEvent(__subscription_events(resource_id, __get_since(query)))
+        raise exceptions.ValidationException('A `resource` is required')
+    raise exceptions.NotAuthorizedException()
+
+#===============================================================================
+
+async def __download_content(since: Optional[int], ndjson: bool, compress: bool) -> AsyncIterator[bytes]:
+    # Annotations are read a page at a time and sent as they are encoded
+    compressor = zlib.compressobj(wbits=31) if compress else None    # A gzip stream
+    def encoded(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor is not None else data
+    if not ndjson:
+        yield encoded(b'[')
+    before = None
+    first = True
+    while True:
+        page = await file_executor.run(annotation_store.annotations_page, before, since)
+        if len(page) == 0:
+            break
+        parts = []
+        for annotation in page:
+            text = json.dumps(annotation).encode()
+            if ndjson:
+                parts.append(text + b'\n')
+            else:
+                parts.append(text if first else b', ' + text)
+                first = False
+        if (chunk := encoded(b''.join(parts))):
+            yield chunk
+        if len(page) < DOWNLOAD_PAGE_SIZE:
+            break
+        before = (page[-1]['created'], page[-1]['annotationId'])
+    end = b'' if ndjson else b']'
+    yield (encoded(end) + compressor.flush()) if compressor is not None else end
+
 @get('download/')
-async def annotator_download(request: Request)  -> list[dict]:
+async def annotator_download(query: dict[str, Any], request: Request)  -> Stream:
+    """
+    Download all annotations, newest first.
+
+    Annotations are streamed as a JSON array or, if the ``format`` query
+    parameter is ``ndjson`` or the request accepts ``application/x-ndjson``,
+    as newline-delimited JSON. The stream is ``gzip`` compressed when the
+    client accepts it.
+    """
     if __authenticated_bearer(request):
-        annotation_store = AnnotationStore()
-        annotations = annotation_store.annotations()
-        annotation_store.close()
-        return annotations
+        since = __get_since(query)
+        cursor = await file_executor.run(annotation_store.change_cursor)
+        ndjson = (query.get('format') == 'ndjson'
+               or NDJSON_MEDIA_TYPE in request.headers.get('accept', ''))
+        # The response's type and encoding depend on these request headers
+        headers = {CURSOR_HEADER: str(cursor), 'Vary': 'Accept-Encoding, Accept'}
+        compress = accepts_encoding(request.headers.get('accept-encoding', ''), 'gzip')
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+        return Stream(__download_content(since, ndjson, compress),
+                      media_type=NDJSON_MEDIA_TYPE if ndjson else MediaType.JSON,
+                      headers=headers)
     raise exceptions.NotAuthorizedException()
 
 #===============================================================================
@@ -521,8 +1228,10 @@ annotator_router = Router(
         annotator_annotation,
         annotator_annotations,
         annotator_authenticate,
+        annotator_bulk_add,
         annotator_download,
         annotator_features,
+        annotator_subscribe,
         annotator_update_status,
         annotator_unauthenticate
         ],
@@ -533,28 +1242,11 @@ annotator_router = Router(
 #===============================================================================
 
 if __name__ == '__main__':
-    import logging
-
+    # Create the annotation store, or upgrade its schema
     store = AnnotationStore(pathlib.Path('flatmaps/annotation_store.db'))
-    if store.db is not None:
-        schema_version: Optional[str] = None
-        row = store.db.execute("select name from sqlite_schema where type='table' and name='metadata'").fetchone()
-        if row is not None:
-            row = store.db.execute("select value from metadata where name='schema_version").fetchone()
-            if row is not None:
-                schema_version = row[0]
-        if schema_version != SCHEMA_VERSION:
-            while schema_version != SCHEMA_VERSION:
-                if (upgrade := SCHEMA_UPGRADES.get(schema_version)) is None:
-                    raise ValueError(f'Unable to upgrade annotation schema from version {schema_version}')
-                logging.warning(f'Upgrading annotation schema from version {schema_version} to {upgrade[0]}')
-                schema_version = upgrade[0]
-                try:
-                    store.db.executescript(upgrade[1])
-                except sqlite3.Error as e:
-                    store.db.rollback()
-                    raise ValueError(f'Unable to upgrade annotation schema to version {schema_version}: {str(e)}')
-                store.db.commit()
+    with store.database.reader():
+        pass
+    store.close()
 
 #===============================================================================
 #===============================================================================
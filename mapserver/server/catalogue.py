@@ -0,0 +1,367 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import base64
+import bisect
+from dataclasses import dataclass
+import json
+import pathlib
+import sqlite3
+import threading
+from typing import Any, Optional
+
+#===============================================================================
+
+from landez.sources import MBTilesReader, InvalidFormatError
+
+#===============================================================================
+
+from ..mbtiles import file_signature, FileSignature
+from ..settings import settings
+from ..utils import get_metadata, json_metadata
+
+#===============================================================================
+"""
+If a file with this name exists in the map's output directory then the map
+is in the process of being made
+"""
+MAKER_SENTINEL = '.map_making'
+
+#===============================================================================
+
+FLATMAP_PATH_PREFIX = 'flatmap'
+
+#===============================================================================
+
+"""
+Identifies the state of a map's directory: signatures of its ``index.json`` and
+``index.mbtiles`` files, or ``None`` if the map is being made or is incomplete
+"""
+MapSignature = Optional[tuple[FileSignature, FileSignature]]
+
+def map_signature(flatmap_dir: pathlib.Path) -> MapSignature:
+#============================================================
+    if (flatmap_dir / MAKER_SENTINEL).exists():
+        return None
+    try:
+        return (file_signature(flatmap_dir / 'index.json'),
+                file_signature(flatmap_dir / 'index.mbtiles'))
+    except OSError:
+        return None
+
+#===============================================================================
+
+def load_map_summary(flatmap_dir: pathlib.Path) -> Optional[dict[str, Any]]:
+#===========================================================================
+    """
+    Summary of a flatmap for the server's map listing. A version 1.3 or later
+    map has a ``uri`` relative to the server's base URL.
+    """
+    with open(flatmap_dir / 'index.json') as fp:
+        index = json.loads(fp.read())
+    version = index.get('version', 1.0)
+    mbtiles = flatmap_dir / 'index.mbtiles'
+    reader = MBTilesReader(str(mbtiles))
+    if version >= 1.3:
+        metadata: dict[str, Any] = json_metadata(reader, 'metadata')
+        if (('id' not in metadata or flatmap_dir.name != metadata['id'])
+         and ('uuid' not in metadata or flatmap_dir.name != metadata['uuid'].split(':')[-1])):
+            settings['LOGGER'].error(f'Flatmap id mismatch: {flatmap_dir}')
+            return None
+        flatmap = {
+            'id': metadata['id'],
+            'source': metadata['source'],
+            'version': version
+        }
+        if 'uuid' in metadata:
+            flatmap['uuid'] = metadata['uuid']
+            id = metadata['uuid']
+        else:
+            id = metadata['id']
+        flatmap['uri'] = f'{FLATMAP_PATH_PREFIX}/{id}/'
+        if 'created' in metadata:
+            flatmap['created'] = metadata['created']
+            flatmap['creator'] = metadata['creator']
+        if 'git-status' in metadata:
+            flatmap['git-status'] = metadata['git-status']
+        if 'taxon' in metadata:
+            flatmap['taxon'] = metadata['taxon']
+            flatmap['describes'] = metadata['describes'] if 'describes' in metadata else flatmap['taxon']
+        elif 'describes' in metadata:
+            flatmap['taxon'] = metadata['describes']
+            flatmap['describes'] = flatmap['taxon']
+        if 'biological-sex' in metadata:
+            flatmap['biologicalSex'] = metadata['biological-sex']
+        if 'name' in metadata:
+            flatmap['name'] = metadata['name']
+        if 'connectivity' in metadata:
+            flatmap['sckan'] = metadata['connectivity']
+    else:
+        try:
+            source_row = get_metadata(reader, 'source')
+        except (InvalidFormatError, sqlite3.OperationalError):
+            raise IOError(f'Cannot read tile database: {mbtiles}')
+        if source_row is None:
+            return None
+        flatmap = {
+            'id': flatmap_dir.name,
+            'source': source_row[0]
+        }
+        created = get_metadata(reader, 'created')
+        if created is not None:
+            flatmap['created'] = created[0]
+        describes = get_metadata(reader, 'describes')
+        if describes is not None and describes[0]:
+            flatmap['describes'] = describes[0]
+    return flatmap
+
+#===============================================================================
+
+@dataclass
+class MapQuery:
+    taxon: Optional[str] = None
+    biological_sex: Optional[str] = None
+    latest: bool = False
+    created_after: Optional[str] = None
+    created_before: Optional[str] = None
+    limit: Optional[int] = None
+    cursor: Optional[str] = None
+
+    @property
+    def filtered(self) -> bool:
+        return (self.taxon is not None or self.biological_sex is not None or self.latest
+             or self.created_after is not None or self.created_before is not None
+             or self.limit is not None or self.cursor is not None)
+
+#===============================================================================
+
+def encode_cursor(key: tuple[str, str]) -> str:
+#==============================================
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+#=================================================
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(key, list) and len(key) == 2 and all(isinstance(k, str) for k in key):
+            return (key[0], key[1])
+    except ValueError:
+        pass
+    raise ValueError(f'Invalid cursor: {cursor}')
+
+#===============================================================================
+
+class CatalogueIndex:
+    """
+    Indexes of catalogued maps by taxon and biological sex, the latest map
+    for each taxon and sex, and map order by creation time.
+    """
+    def __init__(self, maps: dict[str, dict[str, Any]]):
+        self.__maps = maps
+        self.__by_taxon: dict[str, set[str]] = {}
+        self.__by_sex: dict[str, set[str]] = {}
+        latest_maps: dict[tuple[str, Optional[str]], tuple[str, str]] = {}
+        for (map_uuid, flatmap) in maps.items():
+            if (taxon := flatmap.get('taxon')) is not None:
+                self.__by_taxon.setdefault(taxon, set()).add(map_uuid)
+            if (sex := flatmap.get('biologicalSex')) is not None:
+                self.__by_sex.setdefault(sex, set()).add(map_uuid)
+            # Same selection as ``tools/portal_maps.py``
+            key = (flatmap.get('taxon', flatmap['id']), flatmap.get('biologicalSex'))
+            created = flatmap.get('created', '')
+            if key not in latest_maps or latest_maps[key][0] < created:
+                latest_maps[key] = (created, map_uuid)
+        self.__latest = set(map_uuid for (_, map_uuid) in latest_maps.values())
+        # (created, map_uuid) in ascending order; queries return newest first
+        self.__order = sorted((flatmap.get('created', ''), map_uuid) for (map_uuid, flatmap) in maps.items())
+
+    def query(self, map_query: MapQuery) -> tuple[list[dict[str, Any]], Optional[str]]:
+    #==================================================================================
+        candidates: Optional[set[str]] = None
+        def restrict(map_uuids: set[str]):
+            nonlocal candidates
+            candidates = map_uuids if candidates is None else (candidates & map_uuids)
+        if map_query.latest:
+            restrict(self.__latest)
+        if map_query.taxon is not None:
+            restrict(self.__by_taxon.get(map_query.taxon, set()))
+        if map_query.biological_sex is not None:
+            restrict(self.__by_sex.get(map_query.biological_sex, set()))
+
+        start = len(self.__order)
+        if map_query.cursor is not None:
+            start = bisect.bisect_left(self.__order, decode_cursor(map_query.cursor))
+        if map_query.created_before is not None:
+            start = min(start, bisect.bisect_left(self.__order, (map_query.created_before, '')))
+        maps = []
+        next_cursor = None
+        position = start - 1
+        while position >= 0:
+            (created, map_uuid) = self.__order[position]
+            if map_query.created_after is not None and created <= map_query.created_after:
+                break
+            if candidates is None or map_uuid in candidates:
+                if map_query.limit is not None and len(maps) >= map_query.limit:
+                    next_cursor = encode_cursor(self.__order[position + 1])
+                    break
+                maps.append(self.__maps[map_uuid])
+            position -= 1
+        return (maps, next_cursor)
+
+#===============================================================================
+
+class FlatmapCatalogue:
+    """
+    An in-memory catalogue of the flatmaps under ``FLATMAP_ROOT``.
+
+    New and removed map directories are found when the root directory's
+    modification time changes; maps that are rebuilt in place are found by
+    polling in a background thread, or when the map maker reports that it
+    has made a map.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__maps: dict[str, tuple[MapSignature, Optional[dict[str, Any]]]] = {}
+        self.__index: Optional[CatalogueIndex] = None
+        self.__root_mtime = None
+        self.__terminate_event = threading.Event()
+        self.__poller = None
+
+    @property
+    def root(self) -> pathlib.Path:
+        return pathlib.Path(settings['FLATMAP_ROOT'])
+
+    def maps(self) -> list[dict[str, Any]]:
+    #======================================
+        """
+        All catalogued maps.
+
+        This may scan the flatmap root directory and so blocks.
+        """
+        self.__check_root()
+        with self.__lock:
+            return [summary for (_, summary) in self.__maps.values() if summary is not None]
+
+    def query(self, map_query: MapQuery) -> tuple[list[dict[str, Any]], Optional[str]]:
+    #==================================================================================
+        """
+        Catalogued maps, newest first, that match a query, along with a
+        cursor for the next page of results when the query has a limit.
+
+        This may scan the flatmap root directory and so blocks.
+
+        :raises ValueError: if the query's cursor is invalid
+        """
+        self.__check_root()
+        with self.__lock:
+            if self.__index is None:
+                self.__index = CatalogueIndex({map_uuid: summary
+                                                for (map_uuid, (_, summary)) in self.__maps.items()
+                                                    if summary is not None})
+            index = self.__index
+        return index.query(map_query)
+
+    def refresh(self):
+    #=================
+        """
+        Rescan all map directories, reloading any that have changed.
+        """
+        self.__scan_root(rescan=True)
+
+    def start(self, poll_interval: float):
+    #=====================================
+        self.refresh()
+        if poll_interval > 0 and self.__poller is None:
+            self.__terminate_event.clear()
+            self.__poller = threading.Thread(target=self.__poll, args=(poll_interval,),
+                                             name='catalogue-thread', daemon=True)
+            self.__poller.start()
+
+    def terminate(self):
+    #===================
+        self.__terminate_event.set()
+        self.__poller = None
+
+    def update_map(self, map_uuid: str):
+    #===================================
+        flatmap_dir = self.root / map_uuid
+        if not flatmap_dir.is_dir():
+            with self.__lock:
+                if self.__maps.pop(map_uuid, None) is not None:
+                    self.__index = None
+            return
+        signature = map_signature(flatmap_dir)
+        with self.__lock:
+            if map_uuid in self.__maps and self.__maps[map_uuid][0] == signature:
+                return
+        summary = None
+        if signature is not None:
+            try:
+                summary = load_map_summary(flatmap_dir)
+            except Exception as err:
+                settings['LOGGER'].error(f'Cannot catalogue flatmap {flatmap_dir}: {err}')
+        with self.__lock:
+            self.__maps[map_uuid] = (signature, summary)
+            self.__index = None
+
+    def __check_root(self):
+    #======================
+        try:
+            root_mtime = self.root.stat().st_mtime_ns
+        except OSError:
+            root_mtime = None
+        if root_mtime != self.__root_mtime:
+            self.__scan_root(rescan=False)
+        # Removing a map's sentinel doesn't change the root's mtime, so maps
+        # still being made are checked until they are complete
+        with self.__lock:
+            incomplete_maps = [map_uuid for (map_uuid, (signature, _)) in self.__maps.items()
+                                if signature is None]
+        for map_uuid in incomplete_maps:
+            self.update_map(map_uuid)
+
+    def __poll(self, poll_interval: float):
+    #======================================
+        while not self.__terminate_event.wait(poll_interval):
+            self.refresh()
+
+    def __scan_root(self, rescan: bool):
+    #===================================
+        try:
+            self.__root_mtime = self.root.stat().st_mtime_ns
+            map_uuids = set(path.name for path in self.root.iterdir() if path.is_dir())
+        except OSError:
+            self.__root_mtime = None
+            map_uuids = set()
+        with self.__lock:
+            for map_uuid in set(self.__maps.keys()) - map_uuids:
+                del self.__maps[map_uuid]
+                self.__index = None
+            known_maps = set(self.__maps.keys())
+        for map_uuid in map_uuids:
+            if rescan or map_uuid not in known_maps:
+                self.update_map(map_uuid)
+
+#===============================================================================
+
+flatmap_catalogue = FlatmapCatalogue()
+
+#===============================================================================
+#===============================================================================
@@ -0,0 +1,138 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import statistics
+import threading
+import time
+from typing import Any, Callable, TypeVar
+
+#===============================================================================
+
+from ..settings import settings
+
+#===============================================================================
+
+# Number of recent calls used for latency statistics
+
+LATENCY_WINDOW = 1000
+
+#===============================================================================
+
+T = TypeVar('T')
+
+class IOExecutor:
+    """
+    A pool of threads for running blocking I/O off the server's event loop,
+    keeping metrics of queue depth and of how long calls wait and run for.
+    """
+    def __init__(self, name: str, max_workers: int):
+        self.__name = name
+        self.__max_workers = max_workers
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-io')
+        self.__lock = threading.Lock()
+        self.__queued = 0
+        self.__running = 0
+        self.__completed = 0
+        self.__max_queued = 0
+        self.__wait_times: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.__run_times: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+    #============================================================
+        submitted = time.perf_counter()
+        with self.__lock:
+            self.__queued += 1
+            self.__max_queued = max(self.__queued, self.__max_queued)
+        def call():
+            started = time.perf_counter()
+            with self.__lock:
+                self.__queued -= 1
+                self.__running += 1
+            try:
+                return func(*args)
+            finally:
+                finished = time.perf_counter()
+                with self.__lock:
+                    self.__running -= 1
+                    self.__completed += 1
+                    self.__wait_times.append(started - submitted)
+                    self.__run_times.append(finished - started)
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, call)
+
+    def metrics(self) -> dict[str, Any]:
+    #===================================
+        """
+        Current queue depth and recent latencies, in milliseconds.
+        """
+        with self.__lock:
+            wait_times = list(self.__wait_times)
+            run_times = list(self.__run_times)
+            metrics = {
+                'name': self.__name,
+                'threads': self.__max_workers,
+                'queued': self.__queued,
+                'running': self.__running,
+                'maxQueued': self.__max_queued,
+                'completed': self.__completed,
+            }
+        metrics['wait'] = latency_summary(wait_times)
+        metrics['run'] = latency_summary(run_times)
+        return metrics
+
+    def shutdown(self):
+    #==================
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+#===============================================================================
+
+def latency_summary(times: list[float]) -> dict[str, float]:
+#===========================================================
+    if len(times) == 0:
+        return {}
+    ordered = sorted(times)
+    return {
+        'mean': 1000*statistics.fmean(ordered),
+        'p50': 1000*ordered[len(ordered)//2],
+        'p99': 1000*ordered[min(len(ordered) - 1, (99*len(ordered))//100)],
+        'max': 1000*ordered[-1],
+    }
+
+#===============================================================================
+
+# Tile reads are kept separate from reading larger map files so that
+# a slow file read doesn't hold up tiles
+
+tile_executor = IOExecutor('tile', settings['TILE_IO_THREADS'])
+file_executor = IOExecutor('file', settings['FILE_IO_THREADS'])
+
+def executor_metrics() -> list[dict[str, Any]]:
+#==============================================
+    return [tile_executor.metrics(), file_executor.metrics()]
+
+def shutdown_executors():
+#========================
+    tile_executor.shutdown()
+    file_executor.shutdown()
+
+#===============================================================================
+#===============================================================================
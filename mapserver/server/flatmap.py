@@ -18,35 +18,43 @@
 #
 #===============================================================================
 
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import email.utils
 import gzip
 import io
 import json
+import multiprocessing
 import pathlib
 import sqlite3
-from typing import Any
+import struct
+from typing import Annotated, AsyncIterator, Iterator, NamedTuple, Optional
+import urllib.parse
+import zlib
 
 #===============================================================================
 
-from landez.sources import MBTilesReader, ExtractionError, InvalidFormatError
+from landez.sources import ExtractionError, InvalidFormatError
 
-from litestar import exceptions, get, MediaType, Request, Response, Router
-from litestar.response import File
+from litestar import exceptions, get, MediaType, post, Request, Response, Router
+from litestar.datastructures import ETag
+from litestar.params import Parameter
+from litestar.response import File, Stream
 
 from PIL import Image
 
 #===============================================================================
 
-from ..knowledge.hierarchy import AnatomicalHierarchy
+from ..knowledge.hierarchy import AnatomicalHierarchy, build_sparc_hierarchy, sparc_hierarchy_cached
+from ..mbtiles import bounds_tile_range, mbtiles_pool, TileKey
 from ..settings import settings
-from ..utils import get_metadata, json_metadata, json_map_metadata
+from ..utils import accepts_encoding, encoded_map_metadata, EncodedMetadata
 
-#===============================================================================
-"""
-If a file with this name exists in the map's output directory then the map
-is in the process of being made
-"""
-MAKER_SENTINEL = '.map_making'
+from .catalogue import flatmap_catalogue, MapQuery, MAKER_SENTINEL
+from .executor import file_executor, tile_executor
 
+#===============================================================================
 """
 The name of the log file from when the map was made
 """
@@ -55,103 +63,253 @@ OLD_MAKER_LOG = 'mapmaker.log'
 
 #===============================================================================
 
-FLATMAP_PATH_PREFIX = 'flatmap'
+# Seconds for clients to wait before asking again for a term graph when
+# the anatomical hierarchy isn't yet loaded
 
-#===============================================================================
+HIERARCHY_RETRY_AFTER = 10
 
-# Build and cache a hierarchy of anataomical terms used by a flatmap
+class HierarchyLoader:
+    """
+    Loads the hierarchy of anatomical terms in the background, so that the
+    server can respond to other requests while it is loading.
 
-anatomical_hierarchy = AnatomicalHierarchy()
+    Building the hierarchy from its ontologies is slow, so when it isn't
+    cached this is done in a separate process.
+    """
+    def __init__(self):
+        self.__hierarchy: Optional[AnatomicalHierarchy] = None
+        self.__task: Optional[asyncio.Task] = None
+
+    @property
+    def hierarchy(self) -> Optional[AnatomicalHierarchy]:
+        return self.__hierarchy
+
+    def start(self):
+    #===============
+        """
+        Start loading the hierarchy, unless it is loaded or loading.
+        """
+        if self.__hierarchy is None and self.__task is None:
+            self.__task = asyncio.create_task(self.__load())
+
+    def terminate(self):
+    #===================
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    async def __load(self):
+    #======================
+        try:
+            if not sparc_hierarchy_cached():
+                settings['LOGGER'].info('Building anatomical hierarchy...')
+                # Spawn rather than fork, as the server has threads
+                executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+                try:
+                    await asyncio.get_running_loop().run_in_executor(executor, build_sparc_hierarchy)
+                finally:
+                    executor.shutdown(wait=False, cancel_futures=True)
+            self.__hierarchy = await file_executor.run(AnatomicalHierarchy)
+            settings['LOGGER'].info('Anatomical hierarchy loaded')
+        except Exception as e:
+            # Loading will be tried again when next needed
+            settings['LOGGER'].error(f'Unable to load anatomical hierarchy: {str(e)}')
+        finally:
+            self.__task = None
+
+# A hierarchy of anatomical terms, from which the hierarchy of terms used by
+# a flatmap is built and cached
+
+anatomical_hierarchy = HierarchyLoader()
 
 #===============================================================================
 #===============================================================================
 
-def blank_tile():
+def blank_tile() -> bytes:
     tile = Image.new('RGBA', (1, 1), color=(255, 255, 255, 0))
     file = io.BytesIO()
     tile.save(file, 'png')
     return file.getvalue()
 
+"""
+A transparent PNG, returned for missing image tiles
+"""
+BLANK_TILE = blank_tile()
+
+#===============================================================================
+
+"""
+The maximum number of tiles that can be fetched in a single batch
+"""
+MAX_BATCH_TILES = 256
+
+"""
+Each tile in a batch response is preceded by its zoom level, column, row
+and byte length, as big-endian unsigned integers
+"""
+TILE_FRAME_HEADER = struct.Struct('>BIII')
+
+#===============================================================================
+#===============================================================================
+
+class Validators(NamedTuple):
+    etag: str
+    modified: float
+
+def map_file_validators(map_uuid: str, path: pathlib.Path, variant: str='') -> Optional[Validators]:
+#===================================================================================================
+    """
+    HTTP cache validators for a file of a map, from the map's UUID and the
+    file's modification time and size. There are none while the map is being
+    made or if the file doesn't exist.
+    """
+    if (pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / MAKER_SENTINEL).exists():
+        return None
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return Validators(f'{map_uuid}{variant}-{stat.st_mtime_ns:x}-{stat.st_size:x}', stat.st_mtime)
+
+def cache_headers(validators: Optional[Validators], immutable: bool=False, etag: bool=True) -> dict[str, str]:
+#============================================================================================================
+    """
+    Tiles and images are immutable and can be cached by clients without
+    revalidation; other map files are always revalidated.
+    """
+    if validators is None:
+        return {'Cache-Control': 'no-cache'}
+    headers = {
+        'Cache-Control': f'public, max-age={settings["TILE_MAX_AGE"]}, immutable' if immutable
+                    else 'public, no-cache',
+        'Last-Modified': email.utils.formatdate(validators.modified, usegmt=True)
+    }
+    if etag:
+        headers['ETag'] = ETag(value=validators.etag, weak=True).to_header()
+    return headers
+
+def not_modified(request: Request, validators: Optional[Validators], immutable: bool=False,
+                 vary: Optional[str]=None) -> Optional[Response]:
+#=================================================================
+    """
+    A ``304`` response if the client's cached copy is current. It has the
+    same ``Vary`` header as the full response would.
+    """
+    if validators is None:
+        return None
+    if (if_none_match := request.headers.get('if-none-match')) is not None:
+        matched = any(tag.strip().removeprefix('W/').strip('"') in [validators.etag, '*']
+                        for tag in if_none_match.split(','))
+    elif (if_modified_since := request.headers.get('if-modified-since')) is not None:
+        try:
+            matched = int(validators.modified) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            matched = False
+    else:
+        matched = False
+    if matched:
+        headers = cache_headers(validators, immutable)
+        if vary is not None:
+            headers['Vary'] = vary
+        return Response(content=b'', status_code=304, headers=headers)
+
+async def metadata_stream(chunks: Iterator[bytes], compress: bool) -> AsyncIterator[bytes]:
+#==========================================================================================
+    """
+    Stream a large metadata value, reading and compressing it a chunk at
+    a time in the tile executor.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None    # A gzip stream
+    def next_chunk() -> Optional[bytes]:
+        if (chunk := next(chunks, None)) is not None and compressor is not None:
+            return compressor.compress(chunk)
+        return chunk
+    while (chunk := await tile_executor.run(next_chunk)) is not None:
+        if len(chunk):
+            yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+def map_metadata_response(request: Request, map_uuid: str, name: str) -> Response:
+#=================================================================================
+    """
+    Metadata is sent as stored, without being parsed and re-encoded, and
+    is ``gzip`` compressed when the client accepts it.
+    """
+    validators = map_file_validators(map_uuid, pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'index.mbtiles')
+    if (response := not_modified(request, validators, vary='Accept-Encoding')) is not None:
+        return response
+    headers = cache_headers(validators) | {'Vary': 'Accept-Encoding'}
+    try:
+        metadata = encoded_map_metadata(map_uuid, name)
+    except IOError as err:
+        raise exceptions.NotFoundException(detail=str(err))
+    compress = accepts_encoding(request.headers.get('accept-encoding', ''), 'gzip')
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    if not isinstance(metadata, EncodedMetadata):
+        return Stream(metadata_stream(metadata, compress), media_type=MediaType.JSON, headers=headers)
+    if compress:
+        return Response(content=metadata.gzipped, media_type=MediaType.JSON, headers=headers)
+    return Response(content=metadata.data, media_type=MediaType.JSON, headers=headers)
+
 #===============================================================================
 #===============================================================================
 
 @get('/')
-async def flatmap_maps(request: Request) -> list:
+async def flatmap_maps(request: Request,
+                       taxon: Optional[str]=None,
+                       biological_sex: Annotated[Optional[str], Parameter(query='biologicalSex')]=None,
+                       latest: bool=False,
+                       created_after: Annotated[Optional[str], Parameter(query='createdAfter')]=None,
+                       created_before: Annotated[Optional[str], Parameter(query='createdBefore')]=None,
+                       limit: Annotated[Optional[int], Parameter(gt=0)]=None,
+                       cursor: Optional[str]=None,
+                       fields: Optional[str]=None) -> Response[list]:
     """
     Get a list of available flatmaps.
 
+    :query taxon: only list maps of this taxon
+    :query biologicalSex: only list maps of this biological sex
+    :query latest: only list the most recent map of each taxon and sex
+    :query createdAfter: only list maps created after this ISO timestamp
+    :query createdBefore: only list maps created before this ISO timestamp
+    :query limit: the maximum number of maps to list
+    :query cursor: where to continue a limited listing from
+    :query fields: a comma separated list of the fields to return
+
+    :resheader Link: the URL of the next page of a limited listing
+
     :>jsonarr string id: the flatmap's unique identifier on the server
     :>jsonarr string source: the map's source URL
     :>jsonarr string created: when the map was generated
     :>jsonarr string describes: the map's description
+
+    Maps are listed newest first when any query parameters, except ``fields``,
+    are given.
     """
-    flatmap_list = []
-    root_path = pathlib.Path(settings['FLATMAP_ROOT'])
-    if root_path.is_dir():
-        for flatmap_dir in root_path.iterdir():
-            index = pathlib.Path(settings['FLATMAP_ROOT']) / flatmap_dir / 'index.json'
-            mbtiles = pathlib.Path(settings['FLATMAP_ROOT']) / flatmap_dir / 'index.mbtiles'
-            map_making = pathlib.Path(settings['FLATMAP_ROOT']) / flatmap_dir / MAKER_SENTINEL
-            if (flatmap_dir.is_dir() and not map_making.exists()
-            and index.exists() and mbtiles.exists()):
-                with open(index) as fp:
-                    index = json.loads(fp.read())
-                version = index.get('version', 1.0)
-                reader = MBTilesReader(mbtiles)
-                if version >= 1.3:
-                    metadata: dict[str, Any] = json_metadata(reader, 'metadata')
-                    if (('id' not in metadata or flatmap_dir.name != metadata['id'])
-                     and ('uuid' not in metadata or flatmap_dir.name != metadata['uuid'].split(':')[-1])):
-                        request.logger.error(f'Flatmap id mismatch: {flatmap_dir}')
-                        continue
-                    flatmap = {
-                        'id': metadata['id'],
-                        'source': metadata['source'],
-                        'version': version
-                    }
-                    if 'uuid' in metadata:
-                        flatmap['uuid'] = metadata['uuid']
-                        id = metadata['uuid']
-                    else:
-                        id = metadata['id']
-                    flatmap['uri'] = f'{request.base_url}{FLATMAP_PATH_PREFIX}/{id}/'
-                    if 'created' in metadata:
-                        flatmap['created'] = metadata['created']
-                        flatmap['creator'] = metadata['creator']
-                    if 'git-status' in metadata:
-                        flatmap['git-status'] = metadata['git-status']
-                    if 'taxon' in metadata:
-                        flatmap['taxon'] = metadata['taxon']
-                        flatmap['describes'] = metadata['describes'] if 'describes' in metadata else flatmap['taxon']
-                    elif 'describes' in metadata:
-                        flatmap['taxon'] = metadata['describes']
-                        flatmap['describes'] = flatmap['taxon']
-                    if 'biological-sex' in metadata:
-                        flatmap['biologicalSex'] = metadata['biological-sex']
-                    if 'name' in metadata:
-                        flatmap['name'] = metadata['name']
-                    if 'connectivity' in metadata:
-                        flatmap['sckan'] = metadata['connectivity']
-                else:
-                    source_row = None
-                    try:
-                        source_row = get_metadata(reader, 'source')
-                    except (InvalidFormatError, sqlite3.OperationalError):
-                        raise exceptions.NotFoundException(detail=f'Cannot read tile database: {mbtiles}')
-                    if source_row is None:
-                        continue
-                    flatmap = {
-                        'id': flatmap_dir.name,
-                        'source': source_row[0]
-                    }
-                    created = get_metadata(reader, 'created')
-                    if created is not None:
-                        flatmap['created'] = created[0]
-                    describes = get_metadata(reader, 'describes')
-                    if describes is not None and describes[0]:
-                        flatmap['describes'] = describes[0]
-                flatmap_list.append(flatmap)
-    return flatmap_list
+    map_query = MapQuery(taxon=taxon, biological_sex=biological_sex, latest=latest,
+                         created_after=created_after, created_before=created_before,
+                         limit=limit, cursor=cursor)
+    headers = {}
+    if map_query.filtered:
+        try:
+            flatmaps, next_cursor = await file_executor.run(flatmap_catalogue.query, map_query)
+        except ValueError as err:
+            raise exceptions.ValidationException(detail=str(err))
+        if next_cursor is not None:
+            query = [(key, value) for (key, value) in request.query_params.multi_items() if key != 'cursor']
+            query.append(('cursor', next_cursor))
+            headers['Link'] = f'<{request.url.with_replacements(query=urllib.parse.urlencode(query))}>; rel="next"'
+    else:
+        flatmaps = await file_executor.run(flatmap_catalogue.maps)
+    flatmaps = [flatmap | {'uri': f'{request.base_url}{flatmap["uri"]}'} if 'uri' in flatmap else flatmap
+                    for flatmap in flatmaps]
+    if fields is not None:
+        field_names = [name.strip() for name in fields.split(',')]
+        flatmaps = [{name: flatmap[name] for name in field_names if name in flatmap}
+                        for flatmap in flatmaps]
+    return Response(content=flatmaps, headers=headers)
 
 #===============================================================================
 
@@ -169,6 +327,10 @@ async def flatmap_index(request: Request, map_uuid: str) -> dict|Response:
     doesn't specify a JSON response then the SVG is returned, otherwise the
     flatmap's ``index.json`` is returned.
     """
+    return await file_executor.run(map_index_response, request, map_uuid)
+
+def map_index_response(request: Request, map_uuid: str) -> Response:
+#===================================================================
     index_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'index.json'
     if not index_file.exists():
         return Response(content={'detail': 'Missing map index'}, status_code=404)
@@ -179,9 +341,16 @@ async def flatmap_index(request: Request, map_uuid: str) -> dict|Response:
         if not svg_file.exists():
             svg_file = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'images' / f'{index["id"]}.svg'
         if svg_file.exists():
+            validators = map_file_validators(map_uuid, svg_file, '-svg')
+            if (response := not_modified(request, validators, vary='Accept')) is not None:
+                return response
             with open(svg_file) as fp:
-                return Response(content=fp.read(), media_type='image/svg+xml')
-    return index
+                return Response(content=fp.read(), media_type='image/svg+xml',
+                                headers=cache_headers(validators) | {'Vary': 'Accept'})
+    validators = map_file_validators(map_uuid, index_file)
+    if (response := not_modified(request, validators, vary='Accept')) is not None:
+        return response
+    return Response(content=index, headers=cache_headers(validators) | {'Vary': 'Accept'})
 
 #===============================================================================
 
@@ -198,9 +367,14 @@ async def flatmap_maker_log(map_uuid: str) -> File:
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/style')
-async def flatmap_style(map_uuid: str) -> File:
+async def flatmap_style(request: Request, map_uuid: str) -> File|Response:
     path = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'style.json'
-    return File(path=path, media_type=MediaType.JSON)
+    validators = await file_executor.run(map_file_validators, map_uuid, path)
+    if (response := not_modified(request, validators)) is not None:
+        return response
+    return File(path=path, media_type=MediaType.JSON,
+                etag=ETag(value=validators.etag, weak=True) if validators is not None else None,
+                headers=cache_headers(validators, etag=False))
 
 #===============================================================================
 
@@ -213,85 +387,198 @@ async def flatmap_markers(map_uuid: str) -> File:
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/layers')
-async def flatmap_layers(map_uuid: str) -> dict:
-    try:
-        return json_map_metadata(map_uuid, 'layers')
-    except IOError as err:
-        raise exceptions.NotFoundException(detail=str(err))
+async def flatmap_layers(request: Request, map_uuid: str) -> Response[dict]:
+    return await file_executor.run(map_metadata_response, request, map_uuid, 'layers')
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/metadata')
-async def flatmap_metadata(map_uuid: str) -> dict:
-    try:
-        return json_map_metadata(map_uuid, 'metadata')
-    except IOError as err:
-        raise exceptions.NotFoundException(detail=str(err))
+async def flatmap_metadata(request: Request, map_uuid: str) -> Response[dict]:
+    return await file_executor.run(map_metadata_response, request, map_uuid, 'metadata')
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/pathways')
-async def flatmap_pathways(map_uuid: str) -> dict:
-    try:
-        return json_map_metadata(map_uuid, 'pathways')
-    except IOError as err:
-        raise exceptions.NotFoundException(detail=str(err))
+async def flatmap_pathways(request: Request, map_uuid: str) -> Response[dict]:
+    return await file_executor.run(map_metadata_response, request, map_uuid, 'pathways')
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/images/{image:str}')
-async def flatmap_image(map_uuid: str, image:str) -> Response:
+async def flatmap_image(request: Request, map_uuid: str, image:str) -> Response:
     path = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'images' / image
-    if not path.exists():
+    if not await file_executor.run(path.exists):
         raise exceptions.NotFoundException(detail=f'Missing image: {image}')
-    return File(path=path, filename=image, content_disposition_type='inline')
+    validators = await file_executor.run(map_file_validators, map_uuid, path)
+    if (response := not_modified(request, validators, immutable=True)) is not None:
+        return response
+    return File(path=path, filename=image, content_disposition_type='inline',
+                etag=ETag(value=validators.etag, weak=True) if validators is not None else None,
+                headers=cache_headers(validators, immutable=True, etag=False))
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/mvtiles/{z:int}/{x:int}/{y:int}')
-async def flatmap_vector_tiles(map_uuid: str, z: int, y:int, x: int) -> Response:
+async def flatmap_vector_tiles(request: Request, map_uuid: str, z: int, y:int, x: int) -> Response:
+    """
+    Get a vector tile.
+
+    Compressed tiles are sent as stored, with ``Content-Encoding: gzip``,
+    to clients that accept ``gzip`` encoding, otherwise they are first
+    decompressed.
+    """
+    return await tile_executor.run(vector_tile_response, request, map_uuid, z, x, y)
+
+def vector_tile_response(request: Request, map_uuid: str, z: int, x: int, y: int) -> Response:
+#=============================================================================================
+    validators = map_file_validators(map_uuid, pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'index.mbtiles')
+    # Whether a tile is compressed isn't known until its database is read,
+    # so its encoding is always assumed to vary
+    if (response := not_modified(request, validators, immutable=True, vary='Accept-Encoding')) is not None:
+        return response
+    headers = cache_headers(validators, immutable=True) | {'Vary': 'Accept-Encoding'}
     try:
-        mbtiles = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / 'index.mbtiles'
-        tile_reader = MBTilesReader(mbtiles)
+        tile_reader = mbtiles_pool.reader(map_uuid)
         tile_bytes = tile_reader.tile(z, x, y)
-        if get_metadata(tile_reader, 'compressed'):
-            tile_bytes = gzip.decompress(tile_bytes)
-        return Response(content=tile_bytes, media_type='application/octet-stream')
+        if tile_reader.tile_metadata.compressed:
+            if accepts_encoding(request.headers.get('accept-encoding', ''), 'gzip'):
+                headers['Content-Encoding'] = 'gzip'
+            else:
+                tile_bytes = gzip.decompress(tile_bytes)
+        return Response(content=tile_bytes, media_type='application/octet-stream', headers=headers)
     except ExtractionError:
         pass
     except (InvalidFormatError, sqlite3.OperationalError):
         raise exceptions.NotFoundException(detail='Cannot read tile database')
-    return Response(content='', status_code=204)
+    return Response(content='', status_code=204, headers=headers)
+
+#===============================================================================
+
+@dataclass
+class TileBatchRequest:
+    tiles: Optional[list[list[int]]] = None
+    zoom: Optional[int] = None
+    bounds: Optional[list[float]] = None
+
+@post('flatmap/{map_uuid:str}/mvtiles', status_code=200)
+async def flatmap_vector_tile_batch(data: TileBatchRequest, request: Request, map_uuid: str) -> Response:
+    """
+    Get a batch of vector tiles, read with a single database query.
+
+    :<json array tiles: a list of ``[z, x, y]`` tile positions
+    :<json integer zoom: the zoom level of tiles covering ``bounds``
+    :<json array bounds: ``[west, south, east, north]``, in degrees, with ``west``
+                         not greater than ``east`` and ``south`` not greater
+                         than ``north``
+
+    Either ``tiles``, or ``zoom`` and ``bounds``, are required and at most
+    ``MAX_BATCH_TILES`` tiles can be requested.
+
+    :resheader X-Tile-Content-Encoding: ``gzip`` if tiles are sent compressed
+
+    The response is a sequence of tiles, each preceded by a header of its zoom
+    level (1 byte), column and row (4 bytes each), and byte length (4 bytes),
+    all big-endian. Tiles that don't exist are not included. Compressed tiles
+    are sent as stored to clients that accept ``gzip`` encoding, otherwise they
+    are first decompressed.
+    """
+    if data.tiles is not None:
+        if len(data.tiles) > MAX_BATCH_TILES:
+            raise exceptions.ValidationException(detail=f'At most {MAX_BATCH_TILES} tiles can be requested')
+        tile_keys: list[TileKey] = []
+        for tile in data.tiles:
+            if len(tile) != 3 or not valid_tile(*tile):
+                raise exceptions.ValidationException(detail=f'Invalid tile: {tile}')
+            tile_keys.append((tile[0], tile[1], tile[2]))
+        return await tile_executor.run(vector_tile_batch_response, request, map_uuid, tile_keys, None)
+    elif data.zoom is not None and data.bounds is not None:
+        if not valid_tile(data.zoom, 0, 0) or len(data.bounds) != 4:
+            raise exceptions.ValidationException(detail='Invalid zoom or bounds')
+        (west, south, east, north) = data.bounds
+        if west > east or south > north:
+            # Bounds crossing the antimeridian must be requested as two batches
+            raise exceptions.ValidationException(detail='Bounds must have west <= east and south <= north')
+        (x_range, y_range) = bounds_tile_range(data.zoom, data.bounds)
+        if (x_range[1] - x_range[0] + 1)*(y_range[1] - y_range[0] + 1) > MAX_BATCH_TILES:
+            raise exceptions.ValidationException(detail=f'Bounds cover more than {MAX_BATCH_TILES} tiles')
+        return await tile_executor.run(vector_tile_batch_response, request, map_uuid, None,
+                                       (data.zoom, x_range, y_range))
+    raise exceptions.ValidationException(detail='Either `tiles`, or `zoom` and `bounds`, are required')
+
+def valid_tile(z: int, x: int, y: int) -> bool:
+#==============================================
+    return 0 <= z < 32 and 0 <= x < 2**z and 0 <= y < 2**z
+
+def vector_tile_batch_response(request: Request, map_uuid: str, tile_keys: Optional[list[TileKey]],
+                               tile_range: Optional[tuple[int, tuple[int, int], tuple[int, int]]]) -> Response:
+#==============================================================================================================
+    try:
+        tile_reader = mbtiles_pool.reader(map_uuid)
+        tiles = tile_reader.tiles(tile_keys) if tile_keys is not None else tile_reader.tile_range(*tile_range)  # type: ignore
+    except (InvalidFormatError, sqlite3.OperationalError):
+        raise exceptions.NotFoundException(detail='Cannot read tile database')
+    headers = {}
+    decompress = False
+    if tile_reader.tile_metadata.compressed:
+        headers['Vary'] = 'Accept-Encoding'
+        if accepts_encoding(request.headers.get('accept-encoding', ''), 'gzip'):
+            headers['X-Tile-Content-Encoding'] = 'gzip'
+        else:
+            decompress = True
+    content = bytearray()
+    for ((z, x, y), tile_bytes) in tiles:
+        if decompress:
+            tile_bytes = gzip.decompress(tile_bytes)
+        content += TILE_FRAME_HEADER.pack(z, x, y, len(tile_bytes))
+        content += tile_bytes
+    return Response(content=bytes(content), media_type='application/octet-stream', headers=headers)
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/tiles/{layer:str}/{z:int}/{x:int}/{y:int}')
-async def flatmap_image_tiles(map_uuid: str, layer: str, z: int, y:int, x: int) -> Response:
+async def flatmap_image_tiles(request: Request, map_uuid: str, layer: str, z: int, y:int, x: int) -> Response:
+    return await tile_executor.run(image_tile_response, request, map_uuid, layer, z, x, y)
+
+def image_tile_response(request: Request, map_uuid: str, layer: str, z: int, x: int, y: int) -> Response:
+#=======================================================================================================
+    validators = map_file_validators(map_uuid, pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / f'{layer}.mbtiles')
+    if (response := not_modified(request, validators, immutable=True)) is not None:
+        return response
+    headers = cache_headers(validators, immutable=True)
     try:
-        mbtiles = pathlib.Path(settings['FLATMAP_ROOT']) / map_uuid / f'{layer}.mbtiles'
-        reader = MBTilesReader(mbtiles)
-        return Response(content=reader.tile(z, x, y), media_type='image/png')
+        reader = mbtiles_pool.reader(map_uuid, layer)
+        return Response(content=reader.tile(z, x, y), media_type='image/png', headers=headers)
     except ExtractionError:
         pass
     except (InvalidFormatError, sqlite3.OperationalError):
         raise exceptions.NotFoundException(detail='Cannot read tile database')
-    return Response(content=blank_tile(), media_type='image/png')
+    if settings['MISSING_IMAGE_TILES'] == 'no-content':
+        return Response(content=b'', status_code=204, headers=headers)
+    return Response(content=BLANK_TILE, media_type='image/png', headers=headers)
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/annotations')
-async def flatmap_annotation(map_uuid: str) -> dict:
-    try:
-        return json_map_metadata(map_uuid, 'annotations')
-    except IOError as err:
-        raise exceptions.NotFoundException(detail=str(err))
+async def flatmap_annotation(request: Request, map_uuid: str) -> Response[dict]:
+    return await file_executor.run(map_metadata_response, request, map_uuid, 'annotations')
 
 #===============================================================================
 
 @get('flatmap/{map_uuid:str}/termgraph')
-async def flatmap_termgraph(map_uuid: str) -> dict:
+async def flatmap_termgraph(map_uuid: str) -> dict|Response:
+    """
+    Get the hierarchy of anatomical terms used by a flatmap.
+
+    :resheader Retry-After: seconds to wait before retrying when the
+                            server's anatomical hierarchy is still loading,
+                            with a ``503`` status
+    """
+    if (hierarchy := anatomical_hierarchy.hierarchy) is None:
+        anatomical_hierarchy.start()
+        return Response(content={'error': 'The anatomical hierarchy is loading'},
+                        status_code=503, headers={'Retry-After': str(HIERARCHY_RETRY_AFTER)})
     try:
-        return anatomical_hierarchy.get_hierachy(map_uuid)
+        return await file_executor.run(hierarchy.get_hierachy, map_uuid)
     except IOError as err:
         raise exceptions.NotFoundException(detail=str(err))
 
@@ -313,6 +600,7 @@ flatmap_router = Router(
         flatmap_pathways,
         flatmap_style,
         flatmap_termgraph,
+        flatmap_vector_tile_batch,
         flatmap_vector_tiles
     ]
 )
@@ -19,6 +19,7 @@
 #===============================================================================
 
 from datetime import datetime
+import os
 import sys
 
 #===============================================================================
@@ -28,8 +29,11 @@ from litestar import exceptions, get, post, Request, Response, Router
 #===============================================================================
 
 from ..maker import MakerData, MakerResponse, MakerLogResponse, MakerStatus
+from ..mbtiles import mbtiles_pool
 from ..settings import settings
 
+from .catalogue import flatmap_catalogue
+
 #===============================================================================
 #===============================================================================
 
@@ -42,9 +46,26 @@ def initialise():
     if settings['MAPMAKER_TOKENS'] and 'sphinx' not in sys.modules:
         # Having a Manager prevents Sphinx from exiting and hangs a ``readthedocs`` build
         from ..maker import Manager
+        from .workers import claim_maker, RemoteMaker, serve_maker
 
         global map_maker
-        map_maker = Manager()
+        if settings['SERVER_WORKERS'] == 1:
+            map_maker = Manager(map_made=map_made)
+        elif claim_maker() is not None:
+            # Only one worker process makes maps, with others passing it requests
+            map_maker = Manager(map_made=map_made)
+            serve_maker(map_maker)
+            settings['LOGGER'].info(f'Map maker is in worker {os.getpid()}')
+        else:
+            map_maker = RemoteMaker()
+
+def map_made(result: dict):
+#==========================
+    # Update our catalogue as soon as a new map is available, and stop
+    # using readers of any tiles it has replaced
+    map_uuid = result['uuid'].split(':')[-1]
+    mbtiles_pool.invalidate(map_uuid)
+    flatmap_catalogue.update_map(map_uuid)
 
 def terminate():
 #===============
@@ -0,0 +1,259 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+#===============================================================================
+
+from ..settings import settings
+
+#===============================================================================
+
+SESSION_DATABASE = 'annotator_sessions.db'
+
+# How often, in seconds, to remove expired sessions from the store
+SESSION_SWEEP_INTERVAL = 300
+
+SESSION_SCHEMA = """
+    create table if not exists sessions (key text primary key, data text, expires real);
+    create index if not exists sessions_expires on sessions(expires);
+"""
+
+#===============================================================================
+
+"""
+A session's data and when it expires, as seconds since the epoch
+"""
+SessionEntry = tuple[dict, float]
+
+class SessionStore(ABC):
+    """
+    Base class for the stores that hold annotator sessions.
+    """
+    @abstractmethod
+    def get(self, session_key: str) -> Optional[SessionEntry]:
+    #=========================================================
+        ...
+
+    @abstractmethod
+    def set(self, session_key: str, data: dict, expires: float):
+    #===========================================================
+        ...
+
+    @abstractmethod
+    def delete(self, session_key: str) -> bool:
+    #==========================================
+        ...
+
+    @abstractmethod
+    def sweep(self, now: float) -> int:
+    #==================================
+        """
+        Remove expired sessions, returning how many were removed.
+        """
+        ...
+
+    def close(self):
+    #===============
+        pass
+
+#===============================================================================
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions held by a single server process and lost when it stops.
+    """
+    def __init__(self):
+        self.__sessions: dict[str, SessionEntry] = {}
+        self.__lock = threading.Lock()
+
+    def get(self, session_key: str) -> Optional[SessionEntry]:
+    #=========================================================
+        return self.__sessions.get(session_key)
+
+    def set(self, session_key: str, data: dict, expires: float):
+    #===========================================================
+        with self.__lock:
+            self.__sessions[session_key] = (data, expires)
+
+    def delete(self, session_key: str) -> bool:
+    #==========================================
+        with self.__lock:
+            return self.__sessions.pop(session_key, None) is not None
+
+    def sweep(self, now: float) -> int:
+    #==================================
+        with self.__lock:
+            expired = [key for (key, (_, expires)) in self.__sessions.items() if expires <= now]
+            for key in expired:
+                del self.__sessions[key]
+        return len(expired)
+
+#===============================================================================
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions held in an SQLite database in write-ahead log mode, so that
+    they are shared by server processes and kept when the server restarts.
+    """
+    def __init__(self, db_path: pathlib.Path):
+        self.__db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('pragma journal_mode=WAL')
+        self.__db.execute('pragma synchronous=NORMAL')
+        self.__db.execute('pragma busy_timeout=5000')
+        self.__db.executescript(SESSION_SCHEMA)
+        self.__lock = threading.Lock()
+
+    def get(self, session_key: str) -> Optional[SessionEntry]:
+    #=========================================================
+        with self.__lock:
+            row = self.__db.execute('select data, expires from sessions where key=?', (session_key,)).fetchone()
+        if row is not None:
+            return (json.loads(row[0]), row[1])
+
+    def set(self, session_key: str, data: dict, expires: float):
+    #===========================================================
+        with self.__lock:
+            self.__db.execute('replace into sessions (key, data, expires) values (?, ?, ?)',
+                              (session_key, json.dumps(data), expires))
+
+    def delete(self, session_key: str) -> bool:
+    #==========================================
+        with self.__lock:
+            return self.__db.execute('delete from sessions where key=?', (session_key,)).rowcount > 0
+
+    def sweep(self, now: float) -> int:
+    #==================================
+        with self.__lock:
+            return self.__db.execute('delete from sessions where expires <= ?', (now,)).rowcount
+
+    def close(self):
+    #===============
+        with self.__lock:
+            self.__db.close()
+
+#===============================================================================
+
+class SessionManager:
+    """
+    Annotator sessions, held in a store with a least-recently-used cache in
+    front of it. Sessions expire ``ttl`` seconds after they are created and
+    are removed from the store by a background sweeper.
+
+    A cached session is checked against the store once it has been cached for
+    ``revalidate`` seconds, so that a session ended by another server process
+    isn't used for longer than this.
+    """
+    def __init__(self, ttl: float, cache_size: int=1024, revalidate: float=30):
+        self.__ttl = ttl
+        self.__cache_size = max(1, cache_size)
+        self.__revalidate = revalidate
+        self.__cache: OrderedDict[str, tuple[dict, float, float]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__store: SessionStore = MemorySessionStore()
+        self.__terminate_event = threading.Event()
+        self.__sweeper = None
+
+    def start(self, store: SessionStore, sweep_interval: float=SESSION_SWEEP_INTERVAL):
+    #==================================================================================
+        self.__store = store
+        if sweep_interval > 0 and self.__sweeper is None:
+            self.__terminate_event.clear()
+            self.__sweeper = threading.Thread(target=self.__sweep, args=(sweep_interval,),
+                                              name='session-sweeper', daemon=True)
+            self.__sweeper.start()
+
+    def terminate(self):
+    #===================
+        self.__terminate_event.set()
+        self.__sweeper = None
+        self.__store.close()
+
+    def new(self, session_key: str, data: dict):
+    #===========================================
+        expires = time.time() + self.__ttl
+        self.__store.set(session_key, data, expires)
+        self.__cache_entry(session_key, data, expires)
+
+    def get(self, session_key: str) -> Optional[dict]:
+    #=================================================
+        now = time.time()
+        with self.__lock:
+            if (entry := self.__cache.get(session_key)) is not None:
+                (data, expires, checked) = entry
+                if now < expires and now < checked + self.__revalidate:
+                    self.__cache.move_to_end(session_key)
+                    return data
+                del self.__cache[session_key]
+        if (stored := self.__store.get(session_key)) is None or stored[1] <= now:
+            return None
+        self.__cache_entry(session_key, *stored)
+        return stored[0]
+
+    def delete(self, session_key: str) -> bool:
+    #==========================================
+        with self.__lock:
+            self.__cache.pop(session_key, None)
+        return self.__store.delete(session_key)
+
+    def __cache_entry(self, session_key: str, data: dict, expires: float):
+    #=====================================================================
+        with self.__lock:
+            self.__cache[session_key] = (data, expires, time.time())
+            self.__cache.move_to_end(session_key)
+            while len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+
+    def __sweep(self, sweep_interval: float):
+    #========================================
+        while not self.__terminate_event.wait(sweep_interval):
+            try:
+                if (removed := self.__store.sweep(time.time())):
+                    settings['LOGGER'].info(f'Removed {removed} expired annotator sessions')
+            except sqlite3.Error as err:
+                settings['LOGGER'].error(f'Cannot remove expired annotator sessions: {err}')
+
+#===============================================================================
+
+def session_store(kind: str) -> SessionStore:
+#============================================
+    if kind == 'memory' and settings['SERVER_WORKERS'] > 1:
+        # A session in one process's memory would be unknown to the others
+        settings['LOGGER'].error('Annotator sessions must be shared by server processes, using `sqlite`')
+        kind = 'sqlite'
+    if kind == 'sqlite':
+        return SQLiteSessionStore(pathlib.Path(settings['FLATMAP_ROOT']) / SESSION_DATABASE)
+    elif kind != 'memory':
+        settings['LOGGER'].error(f'Unknown annotator session store `{kind}`, using `memory`')
+    return MemorySessionStore()
+
+#===============================================================================
+
+annotator_sessions = SessionManager(settings['ANNOTATOR_SESSION_TTL'])
+
+#===============================================================================
+#===============================================================================
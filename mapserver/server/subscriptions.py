@@ -0,0 +1,189 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+import logging
+from typing import Any, Callable, Optional
+
+#===============================================================================
+
+from .executor import file_executor
+
+#===============================================================================
+
+# Number of undelivered events a subscriber may have before it is instead
+# sent a single ``reset`` event
+SUBSCRIBER_QUEUE_SIZE = 32
+
+#===============================================================================
+
+"""
+Changes made to the annotations of resources after a change cursor, as the
+store's current cursor along with the changes to each resource.
+"""
+ChangesFunction = Callable[[list[str], int], tuple[int, dict[str, dict[str, Any]]]]
+
+class Subscription:
+    """
+    A subscriber's queue of events about changes to a resource's annotations.
+    A ``None`` event means that the subscription has ended.
+    """
+    def __init__(self, resource_id: str):
+        self.__resource_id = resource_id
+        self.__queue: asyncio.Queue[Optional[tuple[str, dict]]] = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+
+    @property
+    def resource_id(self) -> str:
+        return self.__resource_id
+
+    async def get(self, timeout: float) -> Optional[tuple[str, dict]]:
+    #=================================================================
+        """
+        The next event, as its type and data. Raises ``asyncio.TimeoutError``
+        if there is no event within ``timeout`` seconds.
+        """
+        return await asyncio.wait_for(self.__queue.get(), timeout)
+
+    def push(self, event: Optional[tuple[str, dict]]):
+    #=================================================
+        try:
+            self.__queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The subscriber is behind, so replace its queued events with one
+            # telling it to resynchronise from its last cursor
+            while not self.__queue.empty():
+                self.__queue.get_nowait()
+            self.__queue.put_nowait(None if event is None else ('reset', {
+                'resource': self.__resource_id,
+                'cursor': event[1]['cursor']
+            }))
+
+#===============================================================================
+
+class AnnotationBroker:
+    """
+    Fans out changes to annotations to the subscribers of each resource.
+
+    A single task checks the annotation store for changes to any subscribed
+    resource, either every ``poll_interval`` seconds to find changes made by
+    other server processes, or as soon as it is notified of a local change.
+    The task only runs while there are subscribers, and idle subscribers cost
+    just a waiting coroutine.
+    """
+    def __init__(self, changes: ChangesFunction, cursor: Callable[[], int], poll_interval: float):
+        self.__changes = changes
+        self.__change_cursor = cursor
+        self.__poll_interval = poll_interval
+        self.__subscriptions: dict[str, set[Subscription]] = {}
+        self.__cursor: Optional[int] = None
+        self.__task: Optional[asyncio.Task] = None
+        self.__wakeup: Optional[asyncio.Event] = None
+        self.__start_lock = asyncio.Lock()
+
+    @property
+    def subscriber_count(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self.__subscriptions.values())
+
+    async def subscribe(self, resource_id: str, since: Optional[int]=None) -> Subscription:
+    #======================================================================================
+        """
+        Subscribe to changes to a resource's annotations, starting with any
+        made after ``since``.
+        """
+        subscription = Subscription(resource_id)
+        async with self.__start_lock:
+            # Changes are only looked for while there are subscribers, from
+            # a cursor set once for all of the first subscribers
+            if self.__task is None:
+                self.__cursor = await file_executor.run(self.__change_cursor)
+                self.__wakeup = asyncio.Event()
+                self.__task = asyncio.create_task(self.__run())
+            self.__subscriptions.setdefault(resource_id, set()).add(subscription)
+            cursor = self.__cursor
+        if since is not None and since < cursor:       # type: ignore
+            # Subscribing first means no later change can be missed, although
+            # one may be sent twice
+            try:
+                (cursor, changes) = await file_executor.run(self.__changes, [resource_id], since)
+            except BaseException:
+                self.unsubscribe(subscription)
+                raise
+            if resource_id in changes:
+                subscription.push(('changes', self.__event_data(resource_id, cursor, changes[resource_id])))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+    #=================================================
+        if (subscriptions := self.__subscriptions.get(subscription.resource_id)) is not None:
+            subscriptions.discard(subscription)
+            if len(subscriptions) == 0:
+                del self.__subscriptions[subscription.resource_id]
+
+    def notify(self):
+    #================
+        """
+        Check for changes now, after annotations have been changed locally.
+        """
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+
+    def terminate(self):
+    #===================
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        for subscriptions in self.__subscriptions.values():
+            for subscription in subscriptions:
+                subscription.push(None)
+        self.__subscriptions = {}
+
+    async def __run(self):
+    #=====================
+        while len(self.__subscriptions):
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), self.__poll_interval)   # type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self.__wakeup.clear()                                                   # type: ignore
+            try:
+                (cursor, changes) = await file_executor.run(self.__changes,
+                                                            list(self.__subscriptions),
+                                                            self.__cursor)
+            except Exception as e:
+                logging.error(f'Unable to check for annotation changes: {str(e)}')
+                continue
+            for (resource_id, change) in changes.items():
+                event = ('changes', self.__event_data(resource_id, cursor, change))
+                for subscription in self.__subscriptions.get(resource_id, ()):
+                    subscription.push(event)
+            self.__cursor = cursor
+        self.__task = None
+
+    @staticmethod
+    def __event_data(resource_id: str, cursor: int, change: dict[str, Any]) -> dict:
+    #===============================================================================
+        return {
+            'resource': resource_id,
+            'cursor': cursor,
+            **change
+        }
+
+#===============================================================================
+#===============================================================================
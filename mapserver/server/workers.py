@@ -0,0 +1,161 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import asyncio
+import fcntl
+import hashlib
+from multiprocessing.managers import BaseManager
+import os
+import threading
+from typing import Any, Coroutine, Optional
+
+#===============================================================================
+
+from litestar import exceptions
+
+#===============================================================================
+
+from ..maker import Manager, MakerData, MakerStatus
+from ..settings import settings
+
+#===============================================================================
+
+"""
+Files in ``MAPMAKER_LOGS`` used to elect the worker process that makes maps,
+and by other workers to pass it requests
+"""
+MAKER_LOCK = 'maker.lock'
+MAKER_SOCKET = 'maker.sock'
+
+#===============================================================================
+
+def maker_authkey() -> bytes:
+#============================
+    # All workers have the same maker tokens
+    return hashlib.sha256(' '.join(sorted(settings['MAPMAKER_TOKENS'])).encode()).digest()
+
+def maker_address() -> str:
+#==========================
+    return os.path.join(settings['MAPMAKER_LOGS'], MAKER_SOCKET)
+
+def claim_maker() -> Optional[int]:
+#==================================
+    """
+    Try to become the worker that makes maps, returning a descriptor
+    of the lock file, which is held for the life of the process.
+    """
+    os.makedirs(settings['MAPMAKER_LOGS'], exist_ok=True)
+    lock_fd = os.open(os.path.join(settings['MAPMAKER_LOGS'], MAKER_LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(lock_fd)
+        return None
+    return lock_fd
+
+#===============================================================================
+
+class MakerService:
+    """
+    Runs requests from other workers on the map making worker's event loop.
+    """
+    def __init__(self, manager: Manager, loop: asyncio.AbstractEventLoop):
+        self.__manager = manager
+        self.__loop = loop
+
+    def make(self, data: MakerData) -> MakerStatus:
+    #==============================================
+        return self.__call(self.__manager.make(data))
+
+    def full_log(self, pid: int) -> str:
+    #===================================
+        return self.__call(self.__manager.full_log(pid))
+
+    def get_log(self, id: str, start_line: int) -> str:
+    #==================================================
+        return self.__call(self.__manager.get_log(id, start_line))
+
+    def status(self, id: str) -> MakerStatus:
+    #========================================
+        return self.__call(self.__manager.status(id))
+
+    def __call(self, coroutine: Coroutine) -> Any:
+    #=============================================
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+class MakerServiceClient(BaseManager):
+    pass
+
+MakerServiceClient.register('maker')
+
+def serve_maker(manager: Manager):
+#=================================
+    """
+    Accept map making requests from other workers. Must be called from
+    the worker's event loop.
+    """
+    service = MakerService(manager, asyncio.get_running_loop())
+    class MakerServiceManager(BaseManager):
+        pass
+    MakerServiceManager.register('maker', callable=lambda: service)
+    if os.path.exists(maker_address()):
+        os.remove(maker_address())
+    server = MakerServiceManager(address=maker_address(), authkey=maker_authkey()).get_server()
+    threading.Thread(target=server.serve_forever, name='maker-service', daemon=True).start()
+
+#===============================================================================
+
+class RemoteMaker:
+    """
+    The interface to the map ``Manager`` used by workers that don't make maps.
+    """
+    async def make(self, data: MakerData) -> MakerStatus:
+    #====================================================
+        return await asyncio.to_thread(self.__call, 'make', data)
+
+    async def full_log(self, pid: int) -> str:
+    #=========================================
+        return await asyncio.to_thread(self.__call, 'full_log', pid)
+
+    async def get_log(self, id: str, start_line: int=1) -> str:
+    #==========================================================
+        return await asyncio.to_thread(self.__call, 'get_log', id, start_line)
+
+    async def status(self, id: str) -> MakerStatus:
+    #==============================================
+        return await asyncio.to_thread(self.__call, 'status', id)
+
+    def terminate(self):
+    #===================
+        pass
+
+    def __call(self, method: str, *args) -> Any:
+    #===========================================
+        # Proxies aren't thread safe so each request has its own connection
+        client = MakerServiceClient(address=maker_address(), authkey=maker_authkey())
+        try:
+            client.connect()
+            return getattr(client.maker(), method)(*args)   # type: ignore
+        except OSError as err:
+            settings['LOGGER'].error(f'Cannot reach map maker: {err}')
+            raise exceptions.ServiceUnavailableException(detail='Map maker is unavailable')
+
+#===============================================================================
+#===============================================================================
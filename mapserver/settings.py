@@ -49,8 +49,9 @@ if not os.path.exists(settings['FLATMAP_ROOT']):
 FLATMAP_VIEWER = os.environ.get('FLATMAP_VIEWER', './viewer')
 settings['FLATMAP_VIEWER'] = normalise_path(FLATMAP_VIEWER)
 
-# Set True when run as ``python -m mapserver viewer``
-settings['MAP_VIEWER'] = False
+# Set True when run as ``python -m mapserver viewer``, with worker processes
+# getting it from their environment
+settings['MAP_VIEWER'] = os.environ.get('MAP_VIEWER', '') == 'true'
 
 FLATMAP_SERVER_LOGS = os.environ.get('FLATMAP_SERVER_LOGS', './logs')
 settings['FLATMAP_SERVER_LOGS'] = normalise_path(FLATMAP_SERVER_LOGS)
@@ -68,6 +69,39 @@ settings['FLATMAP_SERVER_URL'] = FLATMAP_SERVER_URL
 
 #===============================================================================
 
+# Maximum number of ``mbtiles`` databases kept open for serving tiles
+
+settings['MBTILES_POOL_SIZE'] = int(os.environ.get('MBTILES_POOL_SIZE', '64'))
+
+# Maximum size, in megabytes, of the cache of encoded map metadata
+
+settings['METADATA_CACHE_SIZE'] = int(os.environ.get('METADATA_CACHE_SIZE', '256'))
+
+# How long browsers may cache tiles, in seconds
+
+settings['TILE_MAX_AGE'] = int(os.environ.get('TILE_MAX_AGE', '86400'))
+
+# Missing image tiles are either a ``blank`` transparent PNG or an empty
+# (``no-content``) response
+
+settings['MISSING_IMAGE_TILES'] = os.environ.get('MISSING_IMAGE_TILES', 'blank')
+
+# How often, in seconds, to check for maps that have been rebuilt in place
+
+settings['CATALOGUE_POLL_INTERVAL'] = float(os.environ.get('CATALOGUE_POLL_INTERVAL', '60'))
+
+# Number of threads for reading tiles, and for reading other map files,
+# without blocking the server's event loop
+
+settings['TILE_IO_THREADS'] = int(os.environ.get('TILE_IO_THREADS', '8'))
+settings['FILE_IO_THREADS'] = int(os.environ.get('FILE_IO_THREADS', '4'))
+
+# Number of server processes. Maps are made by only one of them
+
+settings['SERVER_WORKERS'] = max(1, int(os.environ.get('SERVER_WORKERS', '1')))
+
+#===============================================================================
+
 # Bearer tokens for service authentication
 
 settings['ANNOTATOR_TOKENS'] = os.environ.get('ANNOTATOR_TOKENS', '').split()
@@ -75,5 +109,26 @@ settings['ANNOTATOR_UPDATE'] = os.environ.get('ANNOTATOR_UPDATE', '').split()
 
 settings['MAPMAKER_TOKENS'] = os.environ.get('MAPMAKER_TOKENS', '').split()
 
+#===============================================================================
+
+# Annotator sessions are kept in ``memory``, or in an ``sqlite`` database that
+# is shared by server processes, and expire after ``ANNOTATOR_SESSION_TTL`` seconds
+
+settings['ANNOTATOR_SESSION_STORE'] = os.environ.get('ANNOTATOR_SESSION_STORE', 'sqlite')
+settings['ANNOTATOR_SESSION_TTL'] = int(os.environ.get('ANNOTATOR_SESSION_TTL', '86400'))
+
+# Number of connections for concurrent reads of the annotation database
+
+settings['ANNOTATION_DB_READERS'] = int(os.environ.get('ANNOTATION_DB_READERS', '4'))
+
+# How often, in seconds, to check for annotation changes made by other server
+# processes when there are subscribers to changes
+
+settings['ANNOTATION_POLL_INTERVAL'] = float(os.environ.get('ANNOTATION_POLL_INTERVAL', '1'))
+
+# Maximum size, in megabytes, of the cache of annotated features
+
+settings['FEATURE_CACHE_SIZE'] = int(os.environ.get('FEATURE_CACHE_SIZE', '64'))
+
 #===============================================================================
 #===============================================================================
@@ -18,10 +18,14 @@
 #
 #===============================================================================
 
+from collections import OrderedDict
+from dataclasses import dataclass
+import gzip
 import json
 import os
 import sqlite3
-from typing import Any, Optional
+import threading
+from typing import Any, Iterator, Optional
 
 #===============================================================================
 
@@ -29,10 +33,62 @@ from landez.sources import MBTilesReader, InvalidFormatError
 
 #===============================================================================
 
+from .mbtiles import FileSignature, mbtiles_pool
 from .settings import settings
 
 #===============================================================================
 
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+#=================================================================
+    """
+    Does an ``Accept-Encoding`` header value allow the given content coding?
+
+    An entry for the coding itself takes precedence over a ``*`` entry,
+    wherever they are in the header.
+    """
+    wildcard = None
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        name = name.strip().lower()
+        if name in [encoding, '*']:
+            quality = 1.0
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+                    break
+            if name == encoding:
+                return quality > 0
+            wildcard = quality
+    return wildcard is not None and wildcard > 0
+
+#===============================================================================
+
+def save_json(path: str, data: Any):
+#===================================
+    """
+    Save JSON by replacing any existing file, so that readers, including
+    other server processes, never see a partially written file.
+    """
+    # A temporary file is private to the thread writing it, and is created
+    # with the same permissions as the file it replaces would have been
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+#===============================================================================
+
 def get_metadata(reader: MBTilesReader, name: str) -> Optional[str]:
 #===================================================================
     if (cursor:=reader._query('SELECT value FROM metadata WHERE name=?', (name, ))) is not None:
@@ -50,8 +106,83 @@ def json_metadata(tile_reader: MBTilesReader, name: str) -> dict[str, Any]:
 
 def json_map_metadata(map_id: str, name: str) -> dict[str, Any]:
 #===============================================================
-    mbtiles = os.path.join(settings['FLATMAP_ROOT'], map_id, 'index.mbtiles')
-    return json_metadata(MBTilesReader(mbtiles), name)
+    try:
+        tile_reader = mbtiles_pool.reader(map_id)
+    except InvalidFormatError:
+        raise IOError('Cannot read tile database')
+    return json_metadata(tile_reader, name)
+
+#===============================================================================
+
+@dataclass
+class EncodedMetadata:
+    """
+    A ``metadata`` value, as stored, and its ``gzip`` compression.
+    """
+    signature: FileSignature
+    data: bytes
+    gzipped: bytes
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + len(self.gzipped)
+
+class EncodedMetadataCache:
+    """
+    A least-recently-used cache of map metadata, as stored as JSON in a map's
+    ``mbtiles`` file, bounded by the total size of the cached values. An entry
+    is reloaded when its map has been rebuilt. Values larger than an eighth of
+    the cache are not cached but are streamed from the map's ``mbtiles`` file,
+    as an iterator of chunks that is read outside of the event loop.
+    """
+    def __init__(self, max_bytes: int):
+        self.__max_bytes = max_bytes
+        self.__total_bytes = 0
+        self.__entries: OrderedDict[tuple[str, str], EncodedMetadata] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, map_id: str, name: str) -> EncodedMetadata|Iterator[bytes]:
+    #=========================================================================
+        try:
+            tile_reader = mbtiles_pool.reader(map_id)
+        except InvalidFormatError:
+            raise IOError('Cannot read tile database')
+        key = (map_id, name)
+        with self.__lock:
+            if (entry := self.__entries.get(key)) is not None and entry.signature == tile_reader.signature:
+                self.__entries.move_to_end(key)
+                return entry
+        try:
+            if ((size := tile_reader.metadata_size(name)) is not None
+              and size[1] is not None and size[1] > self.__max_bytes//8):
+                return tile_reader.stream_metadata(size[0])
+            data = tile_reader.raw_metadata(name)
+        except (InvalidFormatError, sqlite3.OperationalError):
+            raise IOError('Cannot read tile database')
+        if data is None:
+            data = b'{}'
+        entry = EncodedMetadata(tile_reader.signature, data, gzip.compress(data))
+        with self.__lock:
+            if (old_entry := self.__entries.pop(key, None)) is not None:
+                self.__total_bytes -= old_entry.size
+            self.__entries[key] = entry
+            self.__total_bytes += entry.size
+            while self.__total_bytes > self.__max_bytes:
+                (_, evicted) = self.__entries.popitem(last=False)
+                self.__total_bytes -= evicted.size
+        return entry
+
+#===============================================================================
+
+encoded_metadata_cache = EncodedMetadataCache(settings['METADATA_CACHE_SIZE']*1024*1024)
+
+def encoded_map_metadata(map_id: str, name: str) -> EncodedMetadata|Iterator[bytes]:
+#===================================================================================
+    """
+    A map's metadata as stored JSON text, either cached or, if large, as
+    a stream of chunks read from the map's ``mbtiles`` file.
+    """
+    return encoded_metadata_cache.get(map_id, name)
 
 #===============================================================================
 #===============================================================================
@@ -0,0 +1,35 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+"""
+The server application as loaded by each worker process when the server is
+run with ``SERVER_WORKERS`` greater than one. Logging is configured before the
+application is started.
+"""
+
+#===============================================================================
+
+from .__main__ import configure_logging
+
+configure_logging()
+
+from .server import app
+
+#===============================================================================
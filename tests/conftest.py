@@ -0,0 +1,35 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import os
+import tempfile
+
+#===============================================================================
+
+# Settings are read when ``mapserver`` is first imported and need existing
+# directories for maps and logs
+
+_test_root = tempfile.mkdtemp(prefix='mapserver-tests-')
+for name in ['flatmaps', 'logs']:
+    os.makedirs(os.path.join(_test_root, name), exist_ok=True)
+os.environ.setdefault('FLATMAP_ROOT', os.path.join(_test_root, 'flatmaps'))
+os.environ.setdefault('FLATMAP_SERVER_LOGS', os.path.join(_test_root, 'logs'))
+
+#===============================================================================
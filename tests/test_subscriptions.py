@@ -0,0 +1,42 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+from litestar import get, Litestar
+from litestar.response import ServerSentEvent
+from litestar.testing import TestClient
+
+#===============================================================================
+
+from mapserver.server.annotator import KEEPALIVE_MESSAGE
+
+#===============================================================================
+
+def test_keepalive_is_only_a_comment():
+    @get('/events')
+    async def events() -> ServerSentEvent:
+        async def messages():
+            yield KEEPALIVE_MESSAGE
+        return ServerSentEvent(messages())
+
+    with TestClient(app=Litestar(route_handlers=[events])) as client:
+        response = client.get('/events')
+    assert response.content == b': keepalive\r\n\r\n'
+
+#===============================================================================
@@ -0,0 +1,46 @@
+#===============================================================================
+#
+#  Flatmap server
+#
+#  Copyright (c) 2019-2024  David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import pytest
+
+#===============================================================================
+
+from mapserver.utils import accepts_encoding
+
+#===============================================================================
+
+@pytest.mark.parametrize('header, accepted', [
+    ('', False),
+    ('gzip', True),
+    ('deflate, gzip;q=0.5', True),
+    ('gzip;q=0', False),
+    ('gzip;q=bad', False),
+    ('br', False),
+    ('*', True),
+    ('*;q=0', False),
+    ('*, gzip;q=0', False),
+    ('gzip;q=0, *', False),
+    ('*;q=0, gzip', True),
+    ('GZIP', True),
+])
+def test_accepts_gzip(header, accepted):
+    assert accepts_encoding(header, 'gzip') == accepted
+
+#===============================================================================
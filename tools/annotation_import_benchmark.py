@@ -0,0 +1,106 @@
+#===============================================================================
+#
+#  Flatmap tools
+#
+#  Copyright (c) 2024 David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import argparse
+import json
+import time
+import uuid
+
+#===============================================================================
+
+import requests
+
+#===============================================================================
+
+def test_annotations(count: int, resource: str) -> list[dict]:
+#=============================================================
+    return [{
+        'resource': resource,
+        'item': f'item-{n}',
+        'creator': {'name': 'Benchmark', 'orcid': '0000-0000-0000-0000'},
+        'comment': f'Benchmark annotation {n}',
+        'feature': {
+            'id': f'feature-{n}',
+            'geometry': {'type': 'Point', 'coordinates': [n, n]},
+            'properties': {}
+        }
+    } for n in range(count)]
+
+#===============================================================================
+
+class AnnotatorClient:
+    def __init__(self, server: str, token: str):
+        self.__url = f'{server.rstrip("/")}/annotator'
+        self.__session = requests.Session()
+        self.__session.headers['Authorization'] = f'Bearer {token}'
+
+    def add_each(self, annotations: list[dict], key: str) -> int:
+    #============================================================
+        # As annotations were added before bulk import, one request per annotation
+        session = self.__session.get(f'{self.__url}/authenticate', params={'key': key}).json()['session']
+        added = 0
+        for annotation in annotations:
+            response = self.__session.post(f'{self.__url}/annotation/',
+                                           json={'key': key, 'session': session, 'data': annotation})
+            if response.ok and 'annotationId' in response.json():
+                added += 1
+        return added
+
+    def add_array(self, annotations: list[dict]) -> int:
+    #===================================================
+        response = self.__session.post(f'{self.__url}/bulk/', json=annotations)
+        return response.json()['added']
+
+    def add_ndjson(self, annotations: list[dict]) -> int:
+    #====================================================
+        lines = (f'{json.dumps(annotation)}\n'.encode() for annotation in annotations)
+        response = self.__session.post(f'{self.__url}/bulk/', data=lines,
+                                       headers={'Content-Type': 'application/x-ndjson'})
+        return response.json()['added']
+
+#===============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the throughput of adding annotations one at a time with bulk import')
+    parser.add_argument('--count', type=int, default=2000, help='Number of annotations to add with each method (default 2000)')
+    parser.add_argument('--key', help='Pennsieve API key of an annotator, to also add annotations one at a time')
+    parser.add_argument('server', metavar='SERVER', help='URL of flatmap server')
+    parser.add_argument('token', metavar='TOKEN', help='A bearer token in the server\'s ANNOTATOR_UPDATE')
+    args = parser.parse_args()
+
+    client = AnnotatorClient(args.server, args.token)
+    methods = [('array', client.add_array), ('ndjson', client.add_ndjson)]
+    if args.key:
+        methods.insert(0, ('each', lambda annotations: client.add_each(annotations, args.key)))
+    print(f'{"Method":10} {"Added":>9} {"Seconds":>9} {"Added/sec":>10}')
+    for (name, add) in methods:
+        # Each run is to a new resource so that earlier runs don't replace features
+        annotations = test_annotations(args.count, f'benchmark-{uuid.uuid4()}')
+        start = time.perf_counter()
+        added = add(annotations)
+        elapsed = time.perf_counter() - start
+        print(f'{name:10} {added:9} {elapsed:9.2f} {added/elapsed if elapsed > 0 else 0:10.1f}')
+
+#===============================================================================
+
+if __name__ == '__main__':
+    main()
+
+#===============================================================================
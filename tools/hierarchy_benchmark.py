@@ -0,0 +1,118 @@
+#===============================================================================
+#
+#  Flatmap tools
+#
+#  Copyright (c) 2024 David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+#===============================================================================
+
+import networkx as nx
+
+#===============================================================================
+
+ANATOMICAL_ROOT = 'UBERON:0000468'
+
+def synthetic_hierarchy(size: int, seed: int) -> nx.DiGraph:
+#===========================================================
+    # Each term is part of, or is a, one to three earlier terms
+    rng = random.Random(seed)
+    graph = nx.DiGraph()
+    graph.add_node(ANATOMICAL_ROOT, label='multicellular organism')
+    terms = [ANATOMICAL_ROOT]
+    for n in range(1, size):
+        term = f'UBERON:{n:07d}'
+        graph.add_node(term, label=f'term {n}')
+        for parent in rng.sample(terms[max(0, n - 1000):], min(n, rng.randint(1, 3))):
+            graph.add_edge(term, parent)
+        terms.append(term)
+    return graph
+
+#===============================================================================
+
+def pairwise_edges(hierarchy, terms: list) -> list[tuple[str, str, int]]:
+#========================================================================
+    # How edges were found before, with a search for every ordered pair of terms
+    edges = []
+    for source in terms:
+        for target in terms:
+            if source != target and (path_length := hierarchy.path_length(source, target)) > 0:
+                edges.append((source.id, target.id, path_length))
+    return edges
+
+def ancestor_edges(hierarchy, terms: list) -> list[tuple[str, str, int]]:
+#========================================================================
+    edges = []
+    for source in terms:
+        ancestor_distances = hierarchy.ancestor_distances(source)
+        for target in terms:
+            if ancestor_distances.get(target.id, -1) > 0:
+                edges.append((source.id, target.id, ancestor_distances[target.id]))
+    return edges
+
+#===============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare finding the paths between the anatomical terms of a map by searching between each pair of terms with searching once from each term')
+    parser.add_argument('--map', help='A flatmap in FLATMAP_ROOT to take terms from, using the cached SPARC hierarchy. Otherwise a synthetic hierarchy is used')
+    parser.add_argument('--size', type=int, default=20000, help='Number of terms in a synthetic hierarchy (default 20000)')
+    parser.add_argument('--terms', type=int, default=1500, help='Number of map terms taken from a synthetic hierarchy (default 1500)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for a synthetic hierarchy')
+    args = parser.parse_args()
+
+    if args.map is None:
+        # The SPARC hierarchy is loaded from its cache in FLATMAP_ROOT
+        os.environ['FLATMAP_ROOT'] = tempfile.mkdtemp()
+        graph = synthetic_hierarchy(args.size, args.seed)
+        with open(os.path.join(os.environ['FLATMAP_ROOT'], 'sparc-hierarchy.json'), 'w') as fp:
+            json.dump(nx.node_link_data(graph, edges='links'), fp)      # type: ignore
+
+    from mapserver.knowledge.hierarchy import NPO_ONTOLOGY, SparcHierarchy, UBERON_ONTOLOGY
+    from mapserver.knowledge.rdf_utils import Uri
+    from mapserver.utils import json_map_metadata
+
+    hierarchy = SparcHierarchy(UBERON_ONTOLOGY, NPO_ONTOLOGY)
+    if args.map is None:
+        terms = set(Uri(term) for term in random.Random(args.seed).sample(sorted(graph.nodes), args.terms))
+    else:
+        terms = set(Uri(term) for term in
+                    [ann.get('models') for ann in json_map_metadata(args.map, 'annotations').values()]
+                        if hierarchy.has(term))
+    terms.add(Uri(ANATOMICAL_ROOT))
+    terms = list(terms)
+
+    print(f'{"Method":10} {"Terms":>7} {"Edges":>9} {"Seconds":>9}')
+    results = {}
+    for (name, find_edges) in [('ancestors', ancestor_edges), ('pairwise', pairwise_edges)]:
+        start = time.perf_counter()
+        results[name] = find_edges(hierarchy, terms)
+        elapsed = time.perf_counter() - start
+        print(f'{name:10} {len(terms):7} {len(results[name]):9} {elapsed:9.2f}')
+    print('Same edges' if results['ancestors'] == results['pairwise'] else 'EDGES DIFFER')
+
+#===============================================================================
+
+if __name__ == '__main__':
+    main()
+
+#===============================================================================
@@ -0,0 +1,128 @@
+#===============================================================================
+#
+#  Flatmap tools
+#
+#  Copyright (c) 2024 David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+"""
+A local stand-in for the parts of the Pennsieve API used by the annotator,
+for testing authentication without Pennsieve credentials. Start the flatmap
+server with ``PENNSIEVE_API_ENDPOINT`` set to this server's URL.
+"""
+
+#===============================================================================
+
+import argparse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import time
+import urllib.parse
+
+#===============================================================================
+
+# API keys of test users. Members of the annotation team can update annotations
+
+DEFAULT_USERS = {
+    'test-key': {
+        'id': 'N:user:test',
+        'firstName': 'Test',
+        'lastName': 'User',
+        'email': 'test@example.org',
+        'orcid': {'orcid': '0000-0002-1825-0097'},
+        'team': True
+    },
+    'guest-key': {
+        'id': 'N:user:guest',
+        'firstName': 'Guest',
+        'lastName': 'User',
+        'email': 'guest@example.org',
+        'orcid': {'orcid': ''},
+        'team': False
+    }
+}
+
+#===============================================================================
+
+class PennsieveStubHandler(BaseHTTPRequestHandler):
+    users: dict[str, dict] = DEFAULT_USERS
+    delay: float = 0
+
+    def do_GET(self):
+    #================
+        url = urllib.parse.urlparse(self.path)
+        if (user := self.__user(url)) is None:
+            self.__send(HTTPStatus.UNAUTHORIZED)
+        elif url.path.rstrip('/') == '/user':
+            self.__send(HTTPStatus.OK, {key: value for (key, value) in user.items() if key != 'team'})
+        elif url.path.startswith('/organizations/') and url.path.endswith('/members'):
+            self.__send(HTTPStatus.OK, [{'id': member['id']} for member in self.users.values() if member.get('team')])
+        else:
+            self.__send(HTTPStatus.NOT_FOUND)
+
+    def do_PUT(self):
+    #================
+        url = urllib.parse.urlparse(self.path)
+        if self.__user(url) is None:
+            self.__send(HTTPStatus.UNAUTHORIZED)
+        elif url.path == '/session/switch-organization':
+            self.__send(HTTPStatus.OK, {})
+        else:
+            self.__send(HTTPStatus.NOT_FOUND)
+
+    def __user(self, url: urllib.parse.ParseResult) -> dict|None:
+    #============================================================
+        api_key = urllib.parse.parse_qs(url.query).get('api_key', [''])[0]
+        return self.users.get(api_key)
+
+    def __send(self, status: HTTPStatus, content=None):
+    #==================================================
+        if self.delay > 0:
+            time.sleep(self.delay)
+        body = json.dumps(content if content is not None else {'message': status.phrase}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+#===============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Pennsieve API used by the flatmap annotator')
+    parser.add_argument('--port', type=int, default=8100, help='Port to listen on (default 8100)')
+    parser.add_argument('--users', help='JSON file of test users, keyed by API key, with `team` set for annotation team members')
+    parser.add_argument('--delay', type=float, default=0, help='Seconds to delay each response by (default 0)')
+    args = parser.parse_args()
+
+    if args.users is not None:
+        with open(args.users) as fp:
+            PennsieveStubHandler.users = json.load(fp)
+    PennsieveStubHandler.delay = args.delay
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), PennsieveStubHandler)
+    print(f'Pennsieve stub listening at http://127.0.0.1:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+#===============================================================================
+
+if __name__ == '__main__':
+    main()
+
+#===============================================================================
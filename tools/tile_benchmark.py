@@ -0,0 +1,99 @@
+#===============================================================================
+#
+#  Flatmap tools
+#
+#  Copyright (c) 2024 David Brooks
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+#===============================================================================
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+#===============================================================================
+
+import requests
+
+#===============================================================================
+
+# ``identity`` is how vector tiles were always sent, with the server
+# decompressing them; ``gzip`` has the server send tiles as stored
+
+ENCODINGS = ['identity', 'gzip']
+
+#===============================================================================
+
+class TileFetcher:
+    def __init__(self, server: str, map_uuid: str, encoding: str):
+        self.__url = f'{server.rstrip("/")}/flatmap/{map_uuid}/mvtiles'
+        self.__headers = {'Accept-Encoding': encoding}
+        self.__local = threading.local()
+
+    def fetch(self, tile: tuple[int, int, int]) -> tuple[int, int]:
+    #==============================================================
+        if (session := getattr(self.__local, 'session', None)) is None:
+            session = requests.Session()
+            self.__local.session = session
+        z, x, y = tile
+        response = session.get(f'{self.__url}/{z}/{x}/{y}', headers=self.__headers, stream=True)
+        wire_bytes = len(response.raw.read(decode_content=False))
+        return (response.status_code, wire_bytes)
+
+#===============================================================================
+
+def benchmark(server: str, map_uuid: str, zoom: int, encoding: str,
+              repeat: int, threads: int) -> dict:
+#=============================================================================
+    tiles = [(zoom, x, y) for x in range(2**zoom) for y in range(2**zoom)] * repeat
+    fetcher = TileFetcher(server, map_uuid, encoding)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(fetcher.fetch, tiles))
+    elapsed = time.perf_counter() - start
+    served = [wire_bytes for (status, wire_bytes) in results if status == 200]
+    return {
+        'encoding': encoding,
+        'requests': len(results),
+        'tiles': len(served),
+        'seconds': elapsed,
+        'tiles/sec': len(results)/elapsed if elapsed > 0 else 0,
+        'bytes': sum(served),
+    }
+
+#===============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare vector tile throughput and bytes on the wire with and without gzip encoding')
+    parser.add_argument('--zoom', type=int, default=3, help='Zoom level of tiles to fetch (default 3)')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of times to fetch each tile (default 10)')
+    parser.add_argument('--threads', type=int, default=8, help='Number of concurrent clients (default 8)')
+    parser.add_argument('server', metavar='SERVER', help='URL of flatmap server')
+    parser.add_argument('map', metavar='MAP_UUID', help='Flatmap to fetch tiles from')
+    args = parser.parse_args()
+
+    results = [benchmark(args.server, args.map, args.zoom, encoding, args.repeat, args.threads)
+                for encoding in ENCODINGS]
+    print(f'{"Encoding":10} {"Requests":>9} {"Tiles":>9} {"Seconds":>9} {"Tiles/sec":>10} {"Bytes":>12}')
+    for result in results:
+        print(f'{result["encoding"]:10} {result["requests"]:9} {result["tiles"]:9} {result["seconds"]:9.2f} '
+              f'{result["tiles/sec"]:10.1f} {result["bytes"]:12}')
+
+#===============================================================================
+
+if __name__ == '__main__':
+    main()
+
+#===============================================================================